@@ -3,9 +3,33 @@
 #the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import invoice
+from . import ir
+from . import purchase
+from . import sale
+from . import stock
 
 
 def register():
     Pool.register(
+        invoice.Invoice,
         invoice.InvoiceLine,
+        ir.Cron,
         module='account_invoice_line_origin', type_='model')
+    Pool.register(
+        invoice.InvoiceLineStockMove,
+        stock.Invoice,
+        stock.Move,
+        stock.ShipmentIn,
+        stock.ShipmentInReturn,
+        stock.ShipmentOut,
+        stock.ShipmentOutReturn,
+        module='account_invoice_line_origin', type_='model',
+        depends=['account_invoice_stock'])
+    Pool.register(
+        purchase.Purchase,
+        module='account_invoice_line_origin', type_='model',
+        depends=['purchase'])
+    Pool.register(
+        sale.Sale,
+        module='account_invoice_line_origin', type_='model',
+        depends=['sale'])
@@ -1,291 +1,1717 @@
 #This file is part account_invoice_line_origin module for Tryton.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
-from trytond.model import fields, Model
+from functools import reduce, wraps
+from operator import and_, or_
+from weakref import WeakKeyDictionary
+from trytond import backend, config
+from trytond.cache import Cache, LRUDict, freeze
+from trytond.model import fields, Index, Model
+from trytond.model.modelsql import convert_from
+from trytond.model.modelstorage import is_leaf
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
-from sql import Cast, Literal, operators
-from sql.functions import Substring, Position
-from sql.operators import Like
+from sql import (
+    Cast, Column, Literal, Null, Query, Union, With, operators)
+from sql.aggregate import Max, Min
+from sql.conditionals import Case, Coalesce
+from sql.functions import Function
+from sql.operators import BinaryOperator, Concat, Exists
+
+
+logger = logging.getLogger(__name__)
+_origin_parent_caches = WeakKeyDictionary()
+_origin_count_caches = WeakKeyDictionary()
+_origin_modified = WeakKeyDictionary()
+_origin_shared_count_cache = None
+_origin_search_companies = WeakKeyDictionary()
+
+
+def origin_stored():
+    "Return if the origin values are stored in the cache columns"
+    return config.getboolean(
+        'account_invoice_line_origin', 'stored', default=False)
+
+
+POSITIVE_OPERATORS = {
+    '!=': '=',
+    'not like': 'like',
+    'not ilike': 'ilike',
+    'not in': 'in',
+    }
+
+
+class SplitPart(Function):
+    __slots__ = ()
+    _function = 'SPLIT_PART'
+
+
+class RegexpMatch(BinaryOperator):
+    __slots__ = ()
+    _operator = '~'
+
+
+def origin_parent_cache():
+    """Return the cache of the origin parent values of the transaction
+
+    It is a LRU dictionary keyed by origin model and id which is reset at each
+    commit. Its size is set by the account.invoice.line.origin_parent option
+    of the cache section."""
+    return _transaction_cache(_origin_parent_caches,
+        'account.invoice.line.origin_parent')
+
+
+def origin_count_cache():
+    """Return the cache of the counts of the origin searches of the
+    transaction
+
+    It is a LRU dictionary keyed by domain and context which is reset at each
+    commit and when the invoice lines, their origins or their shipments are
+    modified. Its size is set by the account.invoice.line.origin_count option
+    of the cache section."""
+    return _transaction_cache(_origin_count_caches,
+        'account.invoice.line.origin_count')
+
+
+def origin_shared_count_cache():
+    """Return the cache of the counts of the origin searches shared by the
+    transactions or None when it is disabled
+
+    The counts expire after the count_duration option of the
+    account_invoice_line_origin section in seconds instead of being cleared
+    on each modification. The transactions which modified the invoice lines,
+    their origins or their shipments do not use it."""
+    global _origin_shared_count_cache
+    duration = config.getint(
+        'account_invoice_line_origin', 'count_duration', default=60)
+    if not duration:
+        return
+    # Created on first use so importing the module again does not
+    # register the same cache name twice
+    if _origin_shared_count_cache is None:
+        _origin_shared_count_cache = Cache(
+            'account.invoice.line.origin_shared_count',
+            duration=duration, context=False)
+    transaction = Transaction()
+    if _origin_modified.get(transaction) != transaction.started_at:
+        return _origin_shared_count_cache
+
+
+def clear_origin_caches(counts_only=False):
+    "Clear the origin caches of the transaction"
+    transaction = Transaction()
+    if not counts_only:
+        origin_parent_cache().clear()
+    origin_count_cache().clear()
+    _origin_modified[transaction] = transaction.started_at
+
+
+def _transaction_cache(caches, name):
+    transaction = Transaction()
+    started_at, cache = caches.get(transaction, (None, None))
+    if started_at != transaction.started_at:
+        cache = LRUDict(config.getint('cache', name,
+                default=config.getint('cache', 'record')))
+        caches[transaction] = (transaction.started_at, cache)
+    return cache
+
+
+def origin_companies():
+    """Return the ids of the companies to which the origin searches are
+    limited, which are the ones of the company rules.
+
+    Inside a search they are the companies resolved when it started as the
+    searchers are called without access check."""
+    pool = Pool()
+    User = pool.get('res.user')
+    transaction = Transaction()
+    if transaction in _origin_search_companies:
+        return _origin_search_companies[transaction]
+    if not transaction.check_access:
+        return []
+    return list(User.get_companies())
+
+
+@contextmanager
+def resolve_origin_companies():
+    "Resolve the companies of the origin searches run inside"
+    transaction = Transaction()
+    if transaction in _origin_search_companies:
+        yield
+        return
+    _origin_search_companies[transaction] = origin_companies()
+    try:
+        yield
+    finally:
+        del _origin_search_companies[transaction]
+
+
+def to_date(value):
+    "Return the date of value which SQLite returns as text for aggregates"
+    if isinstance(value, str):
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    return value
+
+
+def origin_profile():
+    """Return if the origin getters and searchers must be logged
+
+    It is enabled by the profile option as the queries are run again to be
+    measured, the origin_profile context key can only disable it."""
+    return (config.getboolean(
+            'account_invoice_line_origin', 'profile', default=False)
+        and Transaction().context.get('origin_profile', True))
+
+
+def origin_explain():
+    """Return if the query plan of the origin searchers must be logged
+
+    It is enabled by the explain option, the origin_explain context key can
+    only disable it."""
+    return (config.getboolean(
+            'account_invoice_line_origin', 'explain', default=False)
+        and Transaction().context.get('origin_explain', True))
+
+
+def _explain(sql, params):
+    cursor = Transaction().connection.cursor()
+    if backend.name == 'postgresql':
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+    else:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return '\n'.join(' '.join(str(c) for c in r) for r in cursor)
+
+
+def profile_origin(func):
+    """Log the duration of the origin getter or searcher when profiling is
+    enabled by the profile option.
+
+    The queries returned by a searcher are executed once more to log their
+    SQL, execution time and number of lines."""
+    @wraps(func)
+    def wrapper(cls, *args):
+        if not origin_profile():
+            return func(cls, *args)
+        start = time.perf_counter()
+        result = func(cls, *args)
+        duration = time.perf_counter() - start
+        if func.__name__.startswith('get_'):
+            records, names = args
+            logger.info('%s.%s: %s lines in %.6fs', cls.__name__,
+                func.__name__, len(records), duration)
+            return result
+
+        # The searchers get (name, clause) and the merged ones the clauses
+        clause = args[1] if isinstance(args[0], str) else args[0]
+        logger.info('%s.%s %s: built in %.6fs', cls.__name__,
+            func.__name__, clause, duration)
+        cursor = Transaction().connection.cursor()
+        for sub_clause in result:
+            if (not isinstance(sub_clause, (list, tuple))
+                    or len(sub_clause) < 3
+                    or not isinstance(sub_clause[2], Query)):
+                continue
+            sql, params = tuple(sub_clause[2])
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            count = len(cursor.fetchall())
+            logger.info('%s.%s %s: %s lines in %.6fs\n%s\n%s',
+                cls.__name__, func.__name__, clause, count,
+                time.perf_counter() - start, sql, params)
+            if origin_explain():
+                logger.info('%s.%s %s: plan\n%s', cls.__name__,
+                    func.__name__, clause, _explain(sql, params))
+        return result
+    return wrapper
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+    origin_numbers = fields.Function(fields.Char('Origin Numbers'),
+        'get_origin_summary', searcher='search_origin_numbers')
+    origin_start_date = fields.Function(fields.Date('Origin Start Date'),
+        'get_origin_summary', searcher='search_origin_dates')
+    origin_end_date = fields.Function(fields.Date('Origin End Date'),
+        'get_origin_summary', searcher='search_origin_dates')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.number, Index.Similarity())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.number, Index.Equality())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.reference, Index.Equality())),
+                })
+
+    @classmethod
+    def get_origin_summary(cls, invoices, names):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        cursor = Transaction().connection.cursor()
+
+        numbers = defaultdict(set)
+        start_dates, end_dates = {}, {}
+        for sub_invoices in grouped_slice(invoices):
+            query = InvoiceLine._get_origin_values_query(
+                [i.id for i in sub_invoices])
+            cursor.execute(*query.select(query.invoice, query.number,
+                    Min(query.date), Max(query.date),
+                    group_by=[query.invoice, query.number]))
+            for invoice_id, number, start_date, end_date in cursor:
+                if number:
+                    numbers[invoice_id].add(number)
+                if start_date:
+                    start_date = to_date(start_date)
+                    start_dates[invoice_id] = min(
+                        start_dates.get(invoice_id, start_date), start_date)
+                if end_date:
+                    end_date = to_date(end_date)
+                    end_dates[invoice_id] = max(
+                        end_dates.get(invoice_id, end_date), end_date)
+
+        result = {}
+        for name in names:
+            if name == 'origin_numbers':
+                result[name] = {i.id: ', '.join(sorted(numbers[i.id])) or None
+                    for i in invoices}
+            elif name == 'origin_start_date':
+                result[name] = {i.id: start_dates.get(i.id) for i in invoices}
+            elif name == 'origin_end_date':
+                result[name] = {i.id: end_dates.get(i.id) for i in invoices}
+        return result
+
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None, count=False,
+            query=False):
+        # The searchers of the function fields are called without access
+        # check so the companies are resolved before
+        with resolve_origin_companies():
+            return super().search(domain, offset=offset, limit=limit,
+                order=order, count=count, query=query)
+
+    @classmethod
+    def search_origin_numbers(cls, name, clause):
+        return [('lines.origin_number',) + tuple(clause[1:])]
+
+    @classmethod
+    def search_origin_dates(cls, name, clause):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        line = InvoiceLine.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        Aggregate = Min if name == 'origin_start_date' else Max
+
+        # The aggregated date is the one of a line so only the invoices with
+        # a line matching the clause are aggregated
+        where = line.id.in_(InvoiceLine.search(
+                [('origin_date', operator, value)], order=[], query=True))
+        companies = origin_companies()
+        if companies:
+            where &= line.company.in_(companies)
+        query = InvoiceLine._get_origin_values_query(
+            line.select(line.invoice, where=where))
+        return [('id', 'in', query.select(query.invoice,
+                    group_by=[query.invoice],
+                    having=Operator(Aggregate(query.date), value)))]
+
+    @classmethod
+    def on_modification(cls, mode, invoices, field_names=None):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        super().on_modification(mode, invoices, field_names=field_names)
+        if (mode == 'write'
+                and field_names & {'number', 'reference', 'invoice_date'}):
+            clear_origin_caches()
+        else:
+            clear_origin_caches(counts_only=True)
+        if (mode == 'write' and origin_stored()
+                and field_names & {'number', 'reference', 'invoice_date'}):
+            InvoiceLine.update_origin_cache(InvoiceLine.browse(
+                    InvoiceLine._get_origin_cache_lines(
+                        'account.invoice.line', [i.id for i in invoices])))
 
 
 class InvoiceLine(metaclass=PoolMeta):
     __name__ = 'account.invoice.line'
     origin_number = fields.Function(fields.Char('Origin Number'),
         'get_origin_reference', searcher='search_origin_reference')
+    origin_number_cache = fields.Char('Origin Number Cache', readonly=True)
     origin_reference = fields.Function(fields.Char('Origin Reference'),
         'get_origin_reference', searcher='search_origin_reference')
+    origin_reference_cache = fields.Char('Origin Reference Cache',
+        readonly=True)
     origin_date = fields.Function(fields.Date('Origin Date'),
         'get_origin_reference', searcher='search_origin_reference')
+    origin_date_cache = fields.Date('Origin Date Cache', readonly=True)
+    root_origin_number = fields.Function(fields.Char('Root Origin Number'),
+        'get_root_origin_reference', searcher='search_root_origin_reference')
+    root_origin_reference = fields.Function(
+        fields.Char('Root Origin Reference'),
+        'get_root_origin_reference', searcher='search_root_origin_reference')
+    root_origin_date = fields.Function(fields.Date('Root Origin Date'),
+        'get_root_origin_reference', searcher='search_root_origin_reference')
     # origin_shipment/date fields in __setup__ method
 
     @classmethod
     def __setup__(cls):
         super(InvoiceLine, cls).__setup__()
+        cls.__rpc__.update({
+                'get_origin_lines': RPC(),
+                'search_origin_page': RPC(),
+                })
         if hasattr(cls, 'stock_moves'):
             cls.origin_shipment = fields.Function(fields.Char('Shipment'),
                 'get_origin_shipment', searcher='search_origin_shipment')
+            cls.origin_shipment_cache = fields.Char('Shipment Cache',
+                readonly=True)
+            for model, (name, string) in cls.origin_shipment_fields().items():
+                setattr(cls, name, fields.Function(fields.Many2Many(
+                            model, None, None, string,
+                            order=[('id', 'ASC')]),
+                        'get_origin_shipments',
+                        searcher='search_origin_shipments'))
+            cls.origin_shipment_date = fields.Function(
+                fields.Date('Shipment Date'),
+                'get_origin_shipment_date',
+                searcher='search_origin_shipment_date')
+        t = cls.__table__()
+        if backend.name == 'postgresql':
+            # SQLite refuses the split_part function in index expressions
+            origin_model, origin_id = cls._get_origin_model_id(t)
+            cls._sql_indexes.add(
+                Index(t,
+                    (origin_model, Index.Equality()),
+                    (origin_id, Index.Equality()),
+                    where=t.origin != Null))
+        if origin_stored():
+            cls._sql_indexes.update({
+                    Index(t, (t.origin_number_cache, Index.Equality()),
+                        where=t.origin_number_cache != Null),
+                    Index(t, (t.origin_number_cache, Index.Similarity()),
+                        where=t.origin_number_cache != Null),
+                    Index(t, (t.origin_reference_cache, Index.Equality()),
+                        where=t.origin_reference_cache != Null),
+                    Index(t, (t.origin_reference_cache, Index.Similarity()),
+                        where=t.origin_reference_cache != Null),
+                    Index(t,
+                        (t.origin_date_cache, Index.Range()),
+                        (t.id, Index.Range())),
+                    })
+            if hasattr(cls, 'stock_moves'):
+                cls._sql_indexes.add(
+                    Index(t, (t.origin_shipment_cache, Index.Similarity()),
+                        where=t.origin_shipment_cache != Null))
+
+    @classmethod
+    def __post_setup__(cls):
+        super().__post_setup__()
+        pool = Pool()
+        # Resolve once the origin and shipment models which are activated
+        cls._origin_models = {}
+        for model, origin in cls.origin_reference_models().items():
+            try:
+                Origin = pool.get(model)
+            except KeyError:
+                continue
+            if isinstance(origin, str):
+                origin = {'parent': origin}
+            parent = origin['parent']
+            Parent = pool.get(Origin._fields[parent].model_name)
+            source = Parent.__table__()
+            origin = {
+                'parent': parent,
+                'parent_model': Parent.__name__,
+                'number': origin.get('number', 'number'),
+                'reference': origin.get('reference', 'reference'),
+                'date': origin.get('date', parent + '_date'),
+                'invoice_type': origin.get('invoice_type'),
+                }
+            # Keep only the columns stored in the parent table
+            for key in ['number', 'reference', 'date']:
+                if (origin[key] and cls._get_origin_column(
+                            Parent, source, origin[key]) is None):
+                    origin[key] = None
+            cls._origin_models[model] = origin
+        cls._origin_shipment_models = []
+        if hasattr(cls, 'stock_moves'):
+            for model in cls.origin_shipment_models():
+                try:
+                    pool.get(model)
+                except KeyError:
+                    continue
+                cls._origin_shipment_models.append(model)
+        cls._origin_search_plans = {}
+
+    @classmethod
+    def copy(cls, lines, default=None):
+        default = default.copy() if default is not None else {}
+        default.setdefault('origin_number_cache')
+        default.setdefault('origin_reference_cache')
+        default.setdefault('origin_date_cache')
+        if hasattr(cls, 'stock_moves'):
+            default.setdefault('origin_shipment_cache')
+        return super().copy(lines, default=default)
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        super().on_modification(mode, lines, field_names=field_names)
+        clear_origin_caches(
+            counts_only=not (mode == 'write' and 'invoice' in field_names))
+        if not origin_stored() or mode == 'delete':
+            return
+        if mode == 'create' or field_names & {'origin', 'stock_moves'}:
+            cls.update_origin_cache(lines)
+
+    @staticmethod
+    def _get_origin_model_id(table):
+        """Return the expressions of the model and the id of the origin
+
+        They are the ones of the origin index so the searchers must use them
+        to match the origins. On PostgreSQL the id is NULL when it is not an
+        integer so the cast never fails on a malformed origin, SQLite casts it
+        to 0. Up to 10 digits are cast to BIGINT so all the INTEGER ids are
+        kept."""
+        origin_id = SplitPart(table.origin, ',', 2)
+        if backend.name == 'postgresql':
+            return (SplitPart(table.origin, ',', 1),
+                Case((RegexpMatch(origin_id, '^-?[0-9]{1,10}$'),
+                        Cast(origin_id, 'BIGINT')),
+                    else_=Null))
+        return (SplitPart(table.origin, ',', 1), Cast(origin_id, 'INTEGER'))
 
     @classmethod
     def origin_reference_models(cls):
+        """Return the registry of the origin models.
+
+        Each origin model declares the field of its parent and the number,
+        reference and date columns of the parent. The columns default to
+        number, reference and <parent>_date and can be None when the parent
+        has no such column. The invoice type restricts the searches to the
+        invoices of this type."""
         return {
-            'account.invoice.line': 'invoice',
-            'purchase.line': 'purchase',
-            'sale.line': 'sale',
+            'account.invoice.line': {
+                'parent': 'invoice',
+                'date': 'invoice_date',
+                },
+            'purchase.line': {
+                'parent': 'purchase',
+                'date': 'purchase_date',
+                'invoice_type': 'in',
+                },
+            'sale.line': {
+                'parent': 'sale',
+                'date': 'sale_date',
+                'invoice_type': 'out',
+                },
             }
 
-    def get_origin_reference(self, name):
-        if self.origin and isinstance(self.origin, Model):
-            origin = self.origin
-            parent = self.origin_reference_models().get(origin.__name__)
-            if not parent:
-                return
-
-            source = getattr(origin, parent, None)
-            if not source:
-                return
-
-            if name.endswith('number'):
-                return source.number if hasattr(source, 'number') else None
-            elif name.endswith('reference'):
-                if (hasattr(source, 'number')
-                        and hasattr(source, 'reference')):
-                    references = []
-                    if source.number:
-                        references.append(source.number)
-                    if source.reference:
-                        references.append(source.reference)
-                    reference = ' / '.join(references)
-                elif hasattr(source, 'reference'):
-                    reference = source.reference
-                else:
-                    reference = source.rec_name
-                return reference
-            elif name.endswith('date'):
-                parent_date = getattr(source, parent+'_date', None)
-                return parent_date if parent_date else None
+    @classmethod
+    @profile_origin
+    def get_origin_reference(cls, lines, names):
+        result = {n: {l.id: None for l in lines} for n in names}
+        if origin_stored():
+            values = cls._get_origin_cache_values([l.id for l in lines])
+        else:
+            values = cls._get_origin_values([l.id for l in lines])
+        for line_id, (number, reference, date) in values.items():
+            for name in names:
+                if name.endswith('number'):
+                    result[name][line_id] = number
+                elif name.endswith('reference'):
+                    result[name][line_id] = ' / '.join(
+                        filter(None, [number, reference])) or None
+                elif name.endswith('date'):
+                    result[name][line_id] = date
+        if any(n.endswith('reference') for n in names):
+            rec_names = cls._get_origin_parent_rec_names(lines)
+            for name in names:
+                if name.endswith('reference'):
+                    result[name].update(rec_names)
+        return result
 
     @classmethod
-    def search_origin_reference(cls, name, clause):
+    def _get_origin_parent_rec_names(cls, lines):
+        """Return the record name of the origin parent of each line whose
+        origin model has no reference column"""
+        models = {m for m, i in cls._origin_models.items()
+            if not i['reference']}
+        rec_names = {}
+        if not models:
+            return rec_names
+        for line in lines:
+            origin = line.origin
+            if (not isinstance(origin, Model)
+                    or origin.__name__ not in models or origin.id < 0):
+                continue
+            parent = getattr(origin, cls._origin_models[origin.__name__][
+                    'parent'])
+            if parent:
+                rec_names[line.id] = parent.rec_name
+        return rec_names
+
+    @classmethod
+    def _get_origin_values(cls, line_ids):
+        """Return a dictionary with the (number, reference, date) of the
+        origin parent of each line id.
+        The reference is None when the parent has no reference column.
+
+        Lines are grouped by origin model so each parent model is read with
+        one query per slice of ids."""
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        origins = defaultdict(lambda: defaultdict(list))
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.select(table.id, table.origin,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.origin != Null)))
+            for line_id, origin in cursor:
+                model, _, origin_id = origin.partition(',')
+                if model not in cls._origin_models:
+                    continue
+                try:
+                    origin_id = int(origin_id)
+                except ValueError:
+                    continue
+                if origin_id >= 0:
+                    origins[model][origin_id].append(line_id)
+
+        values = {}
+        for model, origin_lines in origins.items():
+            parent_values = cls._get_origin_parent_values(
+                model, list(origin_lines.keys()))
+            for origin_id, value in parent_values.items():
+                for line_id in origin_lines[origin_id]:
+                    values[line_id] = value
+        return values
+
+    @classmethod
+    def _get_origin_values_query(cls, invoice_ids=None):
+        """Return a query with the invoice, the origin number and the origin
+        date of each line with one union member per origin model.
+        The invoices are restricted to invoice_ids which can be a query."""
         pool = Pool()
-        Invoice = pool.get('account.invoice')
-        try:
-            SaleLine = pool.get('sale.line')
-            Sale = pool.get('sale.sale')
-        except:
-            Sale = None
+        table = cls.__table__()
+        where = table.invoice != Null
+        if isinstance(invoice_ids, Query):
+            where &= table.invoice.in_(invoice_ids)
+        elif invoice_ids is not None:
+            where &= reduce_ids(table.invoice, invoice_ids)
+        if origin_stored():
+            return table.select(table.invoice,
+                table.origin_number_cache.as_('number'),
+                table.origin_date_cache.as_('date'),
+                where=where)
+
+        origin_model, origin_id = cls._get_origin_model_id(table)
+        queries = []
+        for model, info in cls._origin_models.items():
+            origin = pool.get(model).__table__()
+            source = pool.get(info['parent_model']).__table__()
+            queries.append(table.join(origin,
+                    condition=(origin_model == model)
+                    & (origin_id == origin.id)
+                    ).join(source,
+                    condition=Column(origin, info['parent']) == source.id
+                    ).select(table.invoice,
+                    cls._get_origin_parent_value(
+                        model, source, 'number').as_('number'),
+                    cls._get_origin_parent_value(
+                        model, source, 'date').as_('date'),
+                    where=where))
+        if not queries:
+            return table.select(table.invoice,
+                Literal(None).as_('number'), Literal(None).as_('date'),
+                where=Literal(False))
+        return Union(*queries, all_=True)
+
+    @classmethod
+    def _get_origin_parent_values(cls, model, origin_ids):
+        """Return the (number, reference, date) of the parent of each origin
+        of model
+
+        The values are kept in the transaction cache so the parent shared by
+        many origins is read once. The cache is cleared when a parent is
+        modified."""
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        info = cls._origin_models[model]
+        Parent = pool.get(info['parent_model'])
+        origin = pool.get(model).__table__()
+        source = Parent.__table__()
+
+        def column(key):
+            return cls._get_origin_parent_value(model, source, key)
+
+        cache = origin_parent_cache()
+        values, missing = {}, []
+        for origin_id in origin_ids:
+            key = (model, origin_id)
+            if key in cache:
+                cache.move_to_end(key)
+                values[origin_id] = cache[key]
+            else:
+                missing.append(origin_id)
+
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*origin.join(source,
+                    condition=Column(origin, info['parent']) == source.id
+                    ).select(origin.id, column('number'),
+                    column('reference'), column('date'),
+                    where=reduce_ids(origin.id, sub_ids)))
+            for origin_id, number, reference, date in cursor:
+                values[origin_id] = cache[(model, origin_id)] = (
+                    number, reference, date)
+        return values
+
+    @classmethod
+    def iter_origin_data(cls, domain, chunk_size=None):
+        """Yield a dictionary with the id and the origin values of each line
+        matching the domain ordered by id.
+
+        The domain is searched once and its ids are fetched by chunks of
+        chunk_size which are read with the set based getters so the memory
+        used does not grow with the number of lines."""
+        transaction = Transaction()
+        # A cursor of its own keeps the result while the getters query and
+        # on PostgreSQL it is a server side cursor so the ids are not all
+        # buffered by the client
+        if backend.name == 'postgresql':
+            cursor = transaction.connection.cursor(
+                'origin_data_%s' % uuid.uuid4().hex)
+        else:
+            cursor = transaction.connection.cursor()
+        chunk_size = chunk_size or transaction.database.IN_MAX
+        names = ['origin_number', 'origin_reference', 'origin_date']
+
         try:
-            PurchaseLine = pool.get('purchase.line')
-            Purchase = pool.get('purchase.purchase')
-        except:
-            Purchase = None
+            cursor.execute(*cls.search(
+                    domain, order=[('id', 'ASC')], query=True))
+            while True:
+                line_ids = [l for l, in cursor.fetchmany(chunk_size)]
+                if not line_ids:
+                    break
 
-        invoice_type = Transaction().context.get('invoice_type', 'both')
+                lines = cls.browse(line_ids)
+                values = cls.get_origin_reference(lines, names)
+                if 'origin_shipment' in cls._fields:
+                    values['origin_shipment'] = cls.get_origin_shipment(
+                        lines, 'origin_shipment')
+                for line_id in line_ids:
+                    data = {'id': line_id}
+                    for name, name_values in values.items():
+                        data[name] = name_values[line_id]
+                    yield data
+        finally:
+            cursor.close()
 
-        invoice_line = cls.__table__()
-        invoice_line2 = cls.__table__()
-        invoice = Invoice.__table__()
+    @classmethod
+    def _get_origin_order_tables(cls, tables):
+        """Join the origin parents to tables and return the list of
+        (origin model, parent table) for each origin model"""
+        pool = Pool()
+        table, _ = tables[None]
+        result = []
+        for model, info in cls._origin_models.items():
+            parent = info['parent']
+            key = 'origin.' + model
+            if key not in tables:
+                origin = pool.get(model).__table__()
+                source = pool.get(info['parent_model']).__table__()
+                origin_model, origin_id = cls._get_origin_model_id(table)
+                tables[key] = {
+                    None: (origin, (origin_model == model)
+                        & (origin_id == origin.id)),
+                    parent: {
+                        None: (source, Column(origin, parent) == source.id),
+                        },
+                    }
+            source, _ = tables[key][parent][None]
+            result.append((model, source))
+        return result
+
+    @classmethod
+    def _order_origin(cls, tables, names):
+        columns = {n: [] for n in names}
+        for model, source in cls._get_origin_order_tables(tables):
+            for name in names:
+                column = cls._get_origin_parent_column(model, source, name)
+                if column is not None:
+                    columns[name].append(column)
+        return [Coalesce(*columns[n]) for n in names if columns[n]]
+
+    @classmethod
+    def order_origin_number(cls, tables):
+        if origin_stored():
+            table, _ = tables[None]
+            return [table.origin_number_cache]
+        return cls._order_origin(tables, ['number'])
+
+    @classmethod
+    def order_origin_reference(cls, tables):
+        if origin_stored():
+            table, _ = tables[None]
+            return [table.origin_number_cache, table.origin_reference_cache]
+        return cls._order_origin(tables, ['number', 'reference'])
+
+    @classmethod
+    def order_origin_date(cls, tables):
+        if origin_stored():
+            table, _ = tables[None]
+            return [table.origin_date_cache]
+        return cls._order_origin(tables, ['date'])
+
+    @classmethod
+    def _get_origin_cache_values(cls, line_ids):
+        "Return the (number, reference, date) stored in the cache columns"
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        values = {}
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.select(table.id,
+                    table.origin_number_cache, table.origin_reference_cache,
+                    table.origin_date_cache,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.origin != Null)))
+            for line_id, number, reference, date in cursor:
+                values[line_id] = (number, reference, date)
+        return values
+
+    @classmethod
+    def _get_origin_cache_lines(cls, model, parent_ids):
+        "Return the ids of the lines with an origin of model under parent_ids"
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        Origin = pool.get(model)
+        parent = cls._origin_models[model]['parent']
+        table = cls.__table__()
+        origin = Origin.__table__()
+
+        origin_model, origin_id = cls._get_origin_model_id(table)
+        line_ids = []
+        for sub_ids in grouped_slice(parent_ids):
+            query = origin.select(origin.id,
+                where=reduce_ids(Column(origin, parent), sub_ids))
+            cursor.execute(*table.select(table.id,
+                    where=(origin_model == model) & origin_id.in_(query)))
+            line_ids.extend(l for l, in cursor)
+        return line_ids
+
+    @classmethod
+    def _get_origin_shipment_cache_lines(cls, moves=None, shipments=None):
+        "Return the ids of the lines linked to the moves or the shipments"
+        pool = Pool()
+        LineMove = pool.get('account.invoice.line-stock.move')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        line_move = LineMove.__table__()
+        move = Move.__table__()
+
+        line_ids = set()
+        if moves:
+            for sub_ids in grouped_slice(moves):
+                cursor.execute(*line_move.select(line_move.invoice_line,
+                        where=reduce_ids(line_move.stock_move, sub_ids)))
+                line_ids.update(l for l, in cursor)
+        if shipments:
+            for sub_shipments in grouped_slice(shipments):
+                cursor.execute(*line_move.join(move,
+                        condition=line_move.stock_move == move.id
+                        ).select(line_move.invoice_line,
+                        where=move.shipment.in_(list(sub_shipments))))
+                line_ids.update(l for l, in cursor)
+        return list(line_ids)
+
+    @classmethod
+    def update_origin_cache(cls, lines=None):
+        """Store the origin values of the lines in the cache columns.
+
+        When no lines are given, all the lines with an origin are updated in
+        chunks of ids to fill the cache of an existing database. Each chunk
+        is committed so the update does not hold one huge transaction."""
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if lines is not None:
+            for sub_lines in grouped_slice(lines):
+                cls._update_origin_cache([l.id for l in sub_lines])
+            return
+
+        last_id = 0
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=(table.id > last_id) & (table.origin != Null),
+                    order_by=[table.id.asc],
+                    limit=transaction.database.IN_MAX))
+            line_ids = [l for l, in cursor]
+            if not line_ids:
+                break
+            cls._update_origin_cache(line_ids)
+            last_id = line_ids[-1]
+            transaction.commit()
+
+    @classmethod
+    def _update_origin_cache(cls, line_ids):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        columns = [table.origin_number_cache, table.origin_reference_cache,
+            table.origin_date_cache]
+        values = cls._get_origin_values(line_ids)
+        if hasattr(cls, 'stock_moves'):
+            columns.append(table.origin_shipment_cache)
+            with Transaction().set_context(locale=None):
+                shipments = cls.get_origin_shipment(
+                    cls.browse(line_ids), 'origin_shipment')
+            for line_id in line_ids:
+                values[line_id] = values.get(line_id, (None,) * 3) + (
+                    shipments[line_id] or None,)
+        empty = (None,) * len(columns)
 
-        if Sale:
-            sale_line = SaleLine.__table__()
-            sale = Sale.__table__()
-        if Purchase:
-            purchase_line = PurchaseLine.__table__()
-            purchase = Purchase.__table__()
-
-        field, operator_, value = clause
-
-        if operator_ == '!=':
-            PYSQL_CONDITION = 'not'
-        elif operator_ == '=':
-            PYSQL_CONDITION = 'and'
-        elif operator_ == 'not ilike':
-            PYSQL_CONDITION = 'not'
+        ids_per_values = defaultdict(list)
+        for line_id in line_ids:
+            ids_per_values[values.get(line_id, empty)].append(line_id)
+        for value, ids in ids_per_values.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(columns, list(value),
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None, count=False,
+            query=False):
+        # The searchers of the function fields are called before
+        # search_domain so the origin clauses must be merged before
+        with resolve_origin_companies():
+            if not origin_stored():
+                domain = cls._merge_origin_domain(domain)
+            return super().search(domain, offset=offset, limit=limit,
+                order=order, count=count, query=query)
+
+    @classmethod
+    def search_count(cls, domain, offset=0, limit=None):
+        """Count the lines with the cached count of the same domain when it
+        has origin clauses. The count is reused by the transaction until it
+        modifies the lines and by the other transactions for a short time.
+
+        With origin_count_estimate in the context the count is the estimate
+        of the query planner on PostgreSQL."""
+        if not cls._has_origin_clause(domain):
+            return super().search_count(domain, offset=offset, limit=limit)
+        transaction = Transaction()
+        context = transaction.context
+        key = (freeze(domain), offset, limit, transaction.user,
+            transaction.check_access, freeze({k: context.get(k)
+                    for k in cls._origin_count_context_keys()}))
+        cache = origin_count_cache()
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        shared_cache = origin_shared_count_cache()
+        count = shared_cache.get(key) if shared_cache else None
+        if count is None:
+            if (context.get('origin_count_estimate')
+                    and backend.name == 'postgresql'):
+                count = cls._estimate_origin_count(domain, offset, limit)
+            else:
+                count = super().search_count(
+                    domain, offset=offset, limit=limit)
+            if shared_cache:
+                shared_cache.set(key, count)
+        cache[key] = count
+        return count
+
+    @classmethod
+    def _origin_count_context_keys(cls):
+        "Return the context keys on which the origin counts depend"
+        return ['company', 'companies', 'company_filter', 'employee',
+            'invoice_type', 'origin_count_estimate', '_datetime']
+
+    @classmethod
+    def _estimate_origin_count(cls, domain, offset=0, limit=None):
+        "Return the estimate of the query planner of the lines of domain"
+        cursor = Transaction().connection.cursor()
+        sql, params = tuple(cls.search(domain, order=[], query=True))
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan, = cursor.fetchone()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        count = max(int(plan[0]['Plan']['Plan Rows']) - (offset or 0), 0)
+        return min(count, limit) if limit is not None else count
+
+    @classmethod
+    def _has_origin_clause(cls, domain):
+        "Return if the domain has a clause on an origin field"
+        if is_leaf(domain):
+            name = domain[0].split('.', 1)[0]
+            return name.startswith(('origin_', 'root_origin_'))
+        return any(cls._has_origin_clause(d) for d in domain
+            if isinstance(d, (list, tuple)))
+
+    @classmethod
+    def search_origin_page(cls, domain, after=None, limit=None):
+        """Return the ids of the lines matching the domain ordered by origin
+        date and id which follow the (origin date, id) key after, and the key
+        of the last line.
+
+        The page is sought on the key instead of skipping the previous lines
+        with an offset so each page reads only its own lines. The domain is
+        converted into the conditions of the page query instead of a subquery
+        of all its lines. The lines without origin date come last and are
+        read once the dated lines are exhausted."""
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Rule = pool.get('ir.rule')
+        cursor = Transaction().connection.cursor()
+
+        ModelAccess.check(cls.__name__, 'read')
+        with resolve_origin_companies():
+            if not origin_stored():
+                domain = cls._merge_origin_domain(domain)
+            tables, expression = cls.search_domain(domain)
+        rule_domain = Rule.domain_get(cls.__name__, mode='read')
+        if rule_domain:
+            tables, rule_expression = cls.search_domain(
+                rule_domain, active_test=False, tables=tables)
+            expression &= rule_expression
+        table, _ = tables[None]
+        dates = cls.order_origin_date(tables)
+        date = dates[0] if dates else Literal(None)
+        query = convert_from(None, tables)
+
+        def fetch(where, order_by, limit):
+            cursor.execute(*query.select(table.id, date,
+                    where=expression & where, order_by=order_by,
+                    limit=limit))
+            return cursor.fetchall()
+
+        rows = []
+        if not after or after[0] is not None:
+            where = date != Null
+            if after:
+                after_date, after_id = after
+                # The lower bound on the date lets the scan of the index
+                # start at the key
+                where &= ((date >= after_date)
+                    & ((date > after_date) | (table.id > after_id)))
+            rows = fetch(where, [date.asc, table.id.asc], limit)
+        if limit is None or len(rows) < limit:
+            where = date == Null
+            if after and after[0] is None:
+                where &= table.id > after[1]
+            rows += fetch(where, [table.id.asc],
+                limit - len(rows) if limit is not None else None)
+        if not rows:
+            return [], None
+        line_id, date = rows[-1]
+        return [r[0] for r in rows], (to_date(date), line_id)
+
+    @classmethod
+    def _merge_origin_domain(cls, domain, invoice_type=None):
+        """Replace the origin reference clauses of each AND level of the
+        domain by a single clause so the parents are joined once.
+        The invoice type restricted by the domain is used to skip the
+        origins of the other type."""
+        if is_leaf(domain) or not domain:
+            return domain
+        if domain[0] == 'OR':
+            result = ['OR']
+            for sub_domain in domain[1:]:
+                # The leaves of an OR are not merged but the invoice type
+                # still restricts them
+                if (invoice_type and is_leaf(sub_domain)
+                        and cls._has_origin_reference_clause(sub_domain)):
+                    result.append(cls._search_origin_merged(
+                            [tuple(sub_domain)], invoice_type))
+                else:
+                    result.append(
+                        cls._merge_origin_domain(sub_domain, invoice_type))
+            return result
+        if domain[0] == 'AND':
+            result, domain = ['AND'], domain[1:]
         else:
-            PYSQL_CONDITION = 'and'
+            result = []
+        # Infer the invoice type only for the levels with origin clauses as
+        # it may need a query
+        if cls._has_origin_reference_clause(domain):
+            invoice_type = (cls._get_origin_invoice_type(domain)
+                or invoice_type)
+        clauses = []
+        for sub_domain in domain:
+            if is_leaf(sub_domain):
+                if cls._has_origin_reference_clause(sub_domain):
+                    clauses.append(tuple(sub_domain))
+                else:
+                    result.append(sub_domain)
+            else:
+                result.append(
+                    cls._merge_origin_domain(sub_domain, invoice_type))
+        if len(clauses) > 1 or (clauses and invoice_type):
+            result.extend(cls._search_origin_merged(clauses, invoice_type))
+        else:
+            result.extend(clauses)
+        return result
+
+    @classmethod
+    def _has_origin_reference_clause(cls, domain):
+        "Return if the domain has a clause on an origin reference field"
+        if is_leaf(domain):
+            return (len(domain) == 3 and domain[0] in {
+                    'origin_number', 'origin_reference', 'origin_date'})
+        return any(cls._has_origin_reference_clause(d) for d in domain
+            if isinstance(d, (list, tuple)))
 
-        Operator = fields.SQL_OPERATORS[operator_]
+    @classmethod
+    def _get_origin_invoice_type(cls, domain):
+        """Return the invoice type required by the clauses of the AND level
+        of the domain or None"""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        cursor = Transaction().connection.cursor()
+        invoice = Invoice.__table__()
+
+        types = {'in', 'out'}
+        for clause in domain:
+            if not is_leaf(clause) or len(clause) != 3:
+                continue
+            name, operator, value = clause
+            if operator == '=':
+                value = [value]
+            elif operator != 'in' or not isinstance(value, (list, tuple)):
+                continue
+            if name in {'invoice_type', 'invoice.type'}:
+                types &= set(value)
+            elif (name == 'invoice' and value
+                    and all(isinstance(v, int) for v in value)):
+                cursor.execute(*invoice.select(invoice.type,
+                        where=reduce_ids(invoice.id, value),
+                        group_by=[invoice.type]))
+                types &= {t for t, in cursor}
+        if len(types) == 1:
+            return types.pop()
+
+    @classmethod
+    @profile_origin
+    def search_origin_reference(cls, name, clause):
+        if origin_stored():
+            return cls._search_origin_cache(name, clause)
+        return cls._search_origin_parents([(name,) + tuple(clause[1:])])
 
+    @classmethod
+    @profile_origin
+    def _search_origin_merged(cls, clauses, invoice_type=None):
+        "Return the domain of the merged origin reference clauses"
+        return cls._search_origin_parents(clauses, invoice_type)
+
+    @classmethod
+    def _search_origin_parents(cls, clauses, invoice_type=None):
+        """Return the domain of the lines for which the origin parent matches
+        all the clauses on the origin reference fields"""
+        pool = Pool()
+        table = cls.__table__()
+        if not invoice_type:
+            invoice_type = Transaction().context.get('invoice_type', 'both')
+        companies = origin_companies()
+        plans = [cls._get_origin_search_plan(
+                name, operator in POSITIVE_OPERATORS, invoice_type)
+            for name, operator, _ in clauses]
+
+        queries = []
+        for model, info in cls._origin_models.items():
+            if not all(model in p for p in plans):
+                continue
+            Origin = pool.get(model)
+            Parent = pool.get(info['parent_model'])
+            origin = Origin.__table__()
+            source = Parent.__table__()
+
+            wheres = []
+            for (name, operator, value), plan in zip(clauses, plans):
+                names = plan[model]
+                if operator in POSITIVE_OPERATORS:
+                    if not names:
+                        continue
+                    # Exclude the parents matching the positive clause so
+                    # the parents with NULL values are kept
+                    matched = Parent.__table__()
+                    where = cls._get_origin_parent_where(matched, names,
+                        POSITIVE_OPERATORS[operator], value)
+                    wheres.append(~Exists(matched.select(Literal(1),
+                                where=(matched.id == source.id) & where)))
+                else:
+                    wheres.append(cls._get_origin_parent_where(
+                            source, names, operator, value))
+            where = reduce(and_, wheres, Literal(True))
+            if companies and 'company' in Parent._fields:
+                where &= source.company.in_(companies)
+            # Resolve the matching parents first so the lines are matched
+            # on the indexed model and id of the origin
+            origin_model, origin_id = cls._get_origin_model_id(table)
+            origins = origin.select(origin.id,
+                where=Column(origin, info['parent']).in_(
+                    source.select(source.id, where=where)))
+            where = (origin_model == model) & origin_id.in_(origins)
+            if companies:
+                where &= table.company.in_(companies)
+            queries.append(table.select(table.id, where=where))
+
+        if not queries:
+            return [('id', '=', None)]
+        return [('id', 'in', Union(*queries))]
+
+    @classmethod
+    def _get_origin_search_plan(cls, name, negated, invoice_type):
+        """Return a dictionary with the names of the parent columns to search
+        for the origin field name per origin model.
+
+        The models without column are kept only for negated clauses. The
+        plan depends only on the activated modules so it is cached."""
+        key = (name, negated, invoice_type)
+        if key in cls._origin_search_plans:
+            return cls._origin_search_plans[key]
+        plan = {}
+        for model, info in cls._origin_models.items():
+            if (info['invoice_type'] and invoice_type in {'in', 'out'}
+                    and invoice_type != info['invoice_type']):
+                continue
+            names = cls._get_origin_parent_names(name, model)
+            if names or negated:
+                plan[model] = names
+        cls._origin_search_plans[key] = plan
+        return plan
+
+    @classmethod
+    @profile_origin
+    def get_root_origin_reference(cls, lines, names):
+        origin_names = {n: n[len('root_'):] for n in names}
+        roots = cls._get_origin_roots([l.id for l in lines])
+        values = cls.get_origin_reference(
+            cls.browse(set(roots.values())), list(origin_names.values()))
+        return {n: {l.id: values[o][roots[l.id]] for l in lines}
+            for n, o in origin_names.items()}
+
+    @classmethod
+    def _get_origin_roots(cls, line_ids):
+        """Return a dictionary with the root line of each line id.
+
+        The root is the last line of the chain of invoice line origins which
+        has an origin. The chains are read level by level for all the lines
+        at once."""
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        origin = cls.__table__()
+        origin_model, origin_id = cls._get_origin_model_id(table)
+
+        has_origin = SplitPart(origin.origin, ',', 1).in_(
+            list(cls._origin_models))
+        next_lines = {}
+        lines, known = set(line_ids), set(line_ids)
+        while lines:
+            next_level = set()
+            for sub_ids in grouped_slice(lines):
+                cursor.execute(*table.join(origin,
+                        condition=(origin_model == cls.__name__)
+                        & (origin_id == origin.id)
+                        ).select(table.id, origin.id,
+                        where=reduce_ids(table.id, sub_ids) & has_origin))
+                for line_id, next_id in cursor:
+                    next_lines[line_id] = next_id
+                    if next_id not in known:
+                        next_level.add(next_id)
+            known |= next_level
+            lines = next_level
+
+        roots = {}
+        for line_id in line_ids:
+            root, seen = line_id, {line_id}
+            while root in next_lines and next_lines[root] not in seen:
+                root = next_lines[root]
+                seen.add(root)
+            roots[line_id] = root
+        return roots
+
+    @classmethod
+    @profile_origin
+    def search_root_origin_reference(cls, name, clause):
+        _, operator, value = clause
+        negated = operator in POSITIVE_OPERATORS
+        if negated:
+            operator = POSITIVE_OPERATORS[operator]
+        models = list(cls._origin_models)
+        matched = cls.search([(name[len('root_'):], operator, value)],
+            order=[], query=True)
+
+        # The roots are the matching lines which are not followed by a line
+        # with an origin
+        line = cls.__table__()
+        origin = cls.__table__()
+        origin_model, origin_id = cls._get_origin_model_id(line)
+        roots = line.select(line.id,
+            where=line.id.in_(matched)
+            & ~Exists(origin.select(Literal(1),
+                    where=(origin_model == cls.__name__)
+                    & (origin_id == origin.id)
+                    & SplitPart(origin.origin, ',', 1).in_(models))))
+
+        chain = With('id', recursive=True)
+        child = cls.__table__()
+        child_model, child_id = cls._get_origin_model_id(child)
+        chain.query = roots | child.join(chain,
+            condition=(child_model == cls.__name__)
+            & (child_id == chain.id)
+            ).select(child.id)
+        query = chain.select(chain.id, with_=[chain])
+        if negated:
+            table = cls.__table__()
+            query = table.select(table.id,
+                where=SplitPart(table.origin, ',', 1).in_(models)
+                & ~table.id.in_(query))
+        return [('id', 'in', query)]
+
+    @staticmethod
+    def _get_origin_column(Model, table, name):
+        "Return the column of the stored field name or None"
+        field = Model._fields.get(name)
+        if field is None or isinstance(field, fields.Function):
+            return None
+        return Column(table, name)
+
+    @classmethod
+    def _get_origin_parent_names(cls, name, model):
+        """Return the names of the parent columns of the origin model matched
+        by the origin field"""
         if name.endswith('date'):
-            sql_where = (Operator(invoice.invoice_date, value))
+            keys = ['date']
         elif name.endswith('number'):
-            sql_where = (Operator(invoice.number, value))
+            keys = ['number']
         else:
-            sql_where = (Operator(invoice.reference, value))
-
-        query = (invoice_line
-            .join(invoice_line2, 'LEFT', condition=(
-                    (Cast(Substring(invoice_line.origin,
-                                Position(',', invoice_line.origin)
-                        + Literal(1)), 'INTEGER') == invoice_line2.id)
-                    &
-                    (Like(invoice_line.origin, 'account.invoice.line,%'))
-                    ))
-            .join(invoice, 'LEFT', condition=(
-                    invoice_line2.invoice == invoice.id
-                    )))
-
-        # sales
-        if Sale and (invoice_type == 'out' or invoice_type == 'both'):
-            query = query.join(sale_line, 'LEFT', condition=(
-                    (Cast(Substring(invoice_line.origin,
-                                Position(',', invoice_line.origin)
-                        + Literal(1)), 'INTEGER') == sale_line.id)
-                    &
-                    (Like(invoice_line.origin, 'sale.line,%'))
-                    ))
-            query = query.join(sale, 'LEFT', condition=(
-                    sale_line.sale == sale.id
-                    ))
-
-            if name.endswith('date'):
-                sql_where = (sql_where
-                    | (Operator(sale.sale_date, value))
-                    )
-            elif name.endswith('number'):
-                sql_where = (sql_where
-                    | (Operator(sale.number, value))
-                    )
+            keys = ['reference', 'number']
+        info = cls._origin_models[model]
+        return [info[k] for k in keys if info[k]]
+
+    @classmethod
+    def _get_origin_parent_column(cls, model, table, key):
+        "Return the column of the parent table registered for the key or None"
+        name = cls._origin_models[model][key]
+        return Column(table, name) if name else None
+
+    @classmethod
+    def _get_origin_parent_value(cls, model, table, key):
+        "Return the column of the parent table registered for the key or NULL"
+        column = cls._get_origin_parent_column(model, table, key)
+        return column if column is not None else Literal(None)
+
+    @classmethod
+    def _get_origin_parent_where(cls, table, names, operator, value):
+        "Return the condition on the columns names of the parent table"
+        Operator = fields.SQL_OPERATORS[operator]
+        return reduce(or_, (Operator(Column(table, n), value) for n in names))
+
+    @classmethod
+    def get_origin_lines(cls, name, values):
+        """Return a dictionary with the ids of the lines for which the origin
+        field name is equal to each value.
+
+        The values are matched by slices with one query per origin model
+        instead of one search per value. Only the lines readable by the user
+        are returned. The dates are keyed by their ISO format."""
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if name not in {'origin_number', 'origin_reference', 'origin_date'}:
+            raise ValueError("Unknown origin field %r" % name)
+        ModelAccess.check(cls.__name__, 'read')
+        if name == 'origin_date':
+            values = [to_date(v) for v in values]
+        result = {v: [] for v in values}
+        # The search applies the record rules and the active filter
+        where = table.id.in_(cls.search([], order=[], query=True))
+        companies = origin_companies()
+        if companies:
+            where &= table.company.in_(companies)
+
+        def fill(query, columns):
+            for sub_values in grouped_slice(result.keys()):
+                sub_values = list(sub_values)
+                cursor.execute(*query.select(table.id, *columns,
+                        where=where & reduce(or_,
+                            (c.in_(sub_values) for c in columns))))
+                for line_id, *line_values in cursor:
+                    if name == 'origin_date':
+                        line_values = map(to_date, line_values)
+                    for value in set(line_values):
+                        if value in result:
+                            result[value].append(line_id)
+
+        if origin_stored():
+            if name.endswith('reference'):
+                names = ['origin_reference_cache', 'origin_number_cache']
             else:
-                if PYSQL_CONDITION == 'and':
-                    sql_where = (sql_where
-                        | (Operator(sale.reference, value))
-                        | (Operator(sale.number, value))
-                        )
-                else:
-                    sql_where = (sql_where
-                        | (Operator(sale.reference, value))
-                        & (Operator(sale.number, value))
-                        )
-
-        # purchase
-        if Purchase and (invoice_type == 'in' or invoice_type == 'both'):
-            query = query.join(purchase_line, 'LEFT', condition=(
-                    (Cast(Substring(invoice_line.origin,
-                                Position(',', invoice_line.origin)
-                        + Literal(1)), 'INTEGER') == purchase_line.id)
-                    &
-                    (Like(invoice_line.origin, 'purchase.line,%'))
-                    ))
-            query = query.join(purchase, 'LEFT', condition=(
-                    purchase_line.purchase == purchase.id
-                    ))
-
-            if name.endswith('date'):
-                sql_where = (sql_where
-                    | (Operator(purchase.purchase_date, value))
-                    )
-            elif name.endswith('number'):
-                sql_where = (sql_where
-                    | (Operator(purchase.number, value))
-                    )
+                names = [name + '_cache']
+            fill(table, [Column(table, n) for n in names])
+        else:
+            origin_model, origin_id = cls._get_origin_model_id(table)
+            plan = cls._get_origin_search_plan(name, False, 'both')
+            for model, names in plan.items():
+                info = cls._origin_models[model]
+                origin = pool.get(model).__table__()
+                source = pool.get(info['parent_model']).__table__()
+                columns = [Column(source, n) for n in names]
+                fill(table.join(origin,
+                        condition=(origin_model == model)
+                        & (origin_id == origin.id)
+                        ).join(source,
+                        condition=Column(origin, info['parent']) == source.id),
+                    columns)
+        if name == 'origin_date':
+            return {v.isoformat() if v else v: l for v, l in result.items()}
+        return result
+
+    @classmethod
+    def _search_origin_cache(cls, name, clause):
+        _, operator, value = clause
+        if name.endswith('reference'):
+            names = ['origin_reference_cache', 'origin_number_cache']
+        else:
+            names = [name + '_cache']
+        companies = origin_companies()
+        company = [('company', 'in', companies)] if companies else []
+        if operator in POSITIVE_OPERATORS:
+            matched = cls.search(['OR'] + [
+                    (n, POSITIVE_OPERATORS[operator], value) for n in names],
+                order=[], query=True)
+            return [
+                ('origin', '!=', None),
+                ('id', 'not in', matched),
+                ] + company
+        return [['OR'] + [(n, operator, value) for n in names]] + company
+
+    @classmethod
+    def _get_origin_line_shipments(cls, line_ids):
+        "Return the (model, id) of the shipments of each line id"
+        pool = Pool()
+        LineMove = pool.get('account.invoice.line-stock.move')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        line_move = LineMove.__table__()
+        move = Move.__table__()
+
+        line_shipments = defaultdict(set)
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*line_move.join(move,
+                    condition=line_move.stock_move == move.id
+                    ).select(line_move.invoice_line, move.shipment,
+                    where=reduce_ids(line_move.invoice_line, sub_ids)
+                    & (move.shipment != Null)))
+            for line_id, shipment in cursor:
+                model, _, shipment_id = shipment.partition(',')
+                if model not in cls._origin_shipment_models:
+                    continue
+                try:
+                    shipment_id = int(shipment_id)
+                except ValueError:
+                    continue
+                if shipment_id < 0:
+                    continue
+                line_shipments[line_id].add((model, shipment_id))
+        return line_shipments
+
+    @classmethod
+    @profile_origin
+    def get_origin_shipment(cls, lines, name):
+        line_shipments = cls._get_origin_line_shipments([l.id for l in lines])
+        labels = cls._get_origin_shipment_labels(line_shipments)
+        return {l.id: labels.get(l.id, '') for l in lines}
+
+    @classmethod
+    @profile_origin
+    def get_origin_shipments(cls, lines, names):
+        models = {n: m for m, (n, _) in cls.origin_shipment_fields().items()}
+        result = {n: {l.id: [] for l in lines} for n in names}
+        line_shipments = cls._get_origin_line_shipments([l.id for l in lines])
+        for line_id, shipments in line_shipments.items():
+            for name in names:
+                result[name][line_id] = sorted(
+                    i for m, i in shipments if m == models[name])
+        return result
+
+    @classmethod
+    def search_origin_shipments(cls, name, clause):
+        models = {n: m for m, (n, _) in cls.origin_shipment_fields().items()}
+        _, operator, operand, *extra = clause
+        nested = clause[0][len(name):]
+        if not nested:
+            if isinstance(operand, str):
+                nested = '.rec_name'
             else:
-                if PYSQL_CONDITION == 'and':
-                    sql_where = (sql_where
-                        | (Operator(purchase.reference, value))
-                        | (Operator(purchase.number, value))
-                        )
-                else:
-                    sql_where = (sql_where
-                        | (Operator(purchase.reference, value))
-                        & (Operator(purchase.number, value))
-                        )
-        query = query.select(invoice_line.id, where=sql_where)
+                nested = '.id'
+        return [('stock_moves.shipment' + nested,
+                operator, operand, models[name], *extra)]
 
-        return [('id', 'in', query)]
+    @classmethod
+    @profile_origin
+    def get_origin_shipment_date(cls, lines, name):
+        "Return the effective date of the last shipment of each line"
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        line_shipments = cls._get_origin_line_shipments([l.id for l in lines])
+        shipment_ids = defaultdict(set)
+        for shipments in line_shipments.values():
+            for model, shipment_id in shipments:
+                shipment_ids[model].add(shipment_id)
+
+        dates = {}
+        for model, ids in shipment_ids.items():
+            shipment = pool.get(model).__table__()
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*shipment.select(
+                        shipment.id, shipment.effective_date,
+                        where=reduce_ids(shipment.id, sub_ids)
+                        & (shipment.effective_date != Null)))
+                for shipment_id, effective_date in cursor:
+                    dates[(model, shipment_id)] = to_date(effective_date)
+
+        result = {}
+        for line in lines:
+            line_dates = [dates[s] for s in line_shipments.get(line.id, ())
+                if s in dates]
+            result[line.id] = max(line_dates) if line_dates else None
+        return result
+
+    @classmethod
+    @profile_origin
+    def search_origin_shipment_date(cls, name, clause):
+        pool = Pool()
+        LineMove = pool.get('account.invoice.line-stock.move')
+        Move = pool.get('stock.move')
+        line_move = LineMove.__table__()
+        move = Move.__table__()
+
+        _, operator, value = clause
+        companies = origin_companies()
+        # The lines without dated shipment have no date
+        null = value is None and operator in {'=', '!='}
+        if null:
+            operator, value = '!=', None
+        Operator = fields.SQL_OPERATORS[operator]
 
-    def get_origin_shipment(self, name):
+        # Select first on the effective date index the shipments matching the
+        # clause as the last shipment of a matching line matches it too
+        shipments, dates = [], []
+        for model in cls._origin_shipment_models:
+            shipment = pool.get(model).__table__()
+            reference = Concat(model + ',', Cast(shipment.id, 'VARCHAR'))
+            where = Operator(shipment.effective_date, value)
+            if companies:
+                where &= shipment.company.in_(companies)
+            shipments.append(shipment.select(reference, where=where))
+            dates.append(shipment.select(reference.as_('shipment'),
+                    shipment.effective_date.as_('date'),
+                    where=shipment.effective_date != Null))
+        if not shipments:
+            return [] if null and clause[1] == '=' else [('id', '=', None)]
+        lines = line_move.select(line_move.invoice_line,
+            where=line_move.stock_move.in_(move.select(move.id,
+                    where=move.shipment.in_(Union(*shipments)))))
+        if null:
+            if clause[1] == '=':
+                return [('id', 'not in', lines)]
+            return [('id', 'in', lines)]
+
+        # Match the candidate lines on the date of their last shipment like
+        # the getter
+        dates = Union(*dates, all_=True)
+        lines = line_move.join(move,
+            condition=line_move.stock_move == move.id
+            ).join(dates,
+            condition=move.shipment == dates.shipment
+            ).select(line_move.invoice_line,
+            where=line_move.invoice_line.in_(lines),
+            group_by=[line_move.invoice_line],
+            having=Operator(Max(dates.date), value))
+        return [('id', 'in', lines)]
+
+    @classmethod
+    def _get_origin_shipment_labels(cls, record_shipments):
+        """Return the labels of the shipments of each record id from the
+        (model, id) of its shipments"""
+        pool = Pool()
         locale = Transaction().context.get('locale')
         format = locale.get('date', '%Y-%m-%d') if locale else '%Y-%m-%d'
 
-        shipments = set()
-        for move in self.stock_moves:
-            if move.shipment:
-                if move.shipment.effective_date and move.shipment.reference:
-                    key = '%s - %s - %s' % (move.shipment.rec_name,
-                        move.shipment.effective_date.strftime(format),
-                        move.shipment.reference)
-                elif (move.shipment.effective_date and
-                        not move.shipment.reference):
-                    key = '%s - %s' % (move.shipment.rec_name,
-                        move.shipment.effective_date.strftime(format))
-                elif (not move.shipment.effective_date and
-                        move.shipment.reference):
-                    key = '%s - %s ' % (move.shipment.rec_name,
-                        move.shipment.reference)
-                else:
-                    key = '%s' % move.shipment.rec_name
-                shipments.add(key)
+        shipment_ids = defaultdict(set)
+        for shipments in record_shipments.values():
+            for model, shipment_id in shipments:
+                shipment_ids[model].add(shipment_id)
+
+        labels = {}
+        for model, ids in shipment_ids.items():
+            Shipment = pool.get(model)
+            for shipment in Shipment.browse(sorted(ids)):
+                labels[(model, shipment.id)] = cls._get_origin_shipment_label(
+                    shipment, format)
 
-        return ', '.join(shipments)
+        return {r: ', '.join(sorted({labels[s] for s in shipments}))
+            for r, shipments in record_shipments.items()}
+
+    @classmethod
+    def _get_origin_shipment_label(cls, shipment, format):
+        if shipment.effective_date and shipment.reference:
+            return '%s - %s - %s' % (shipment.rec_name,
+                shipment.effective_date.strftime(format),
+                shipment.reference)
+        elif shipment.effective_date and not shipment.reference:
+            return '%s - %s' % (shipment.rec_name,
+                shipment.effective_date.strftime(format))
+        elif not shipment.effective_date and shipment.reference:
+            return '%s - %s ' % (shipment.rec_name, shipment.reference)
+        else:
+            return '%s' % shipment.rec_name
 
     @classmethod
+    @profile_origin
     def search_origin_shipment(cls, name, clause):
+        _, operator, value = clause
+        if (origin_stored() and operator in {'ilike', 'not ilike'}
+                and not cls._get_origin_shipment_date(value)):
+            companies = origin_companies()
+            if companies:
+                return [
+                    ('origin_shipment_cache', operator, value),
+                    ('company', 'in', companies),
+                    ]
+            return [('origin_shipment_cache', operator, value)]
+
         pool = Pool()
         LineMove = pool.get('account.invoice.line-stock.move')
         Move = pool.get('stock.move')
-        ShipmentOut = pool.get('stock.shipment.out')
-        ShipmentOutReturn = pool.get('stock.shipment.out.return')
-        ShipmentIn = pool.get('stock.shipment.in')
-        ShipmentInReturn = pool.get('stock.shipment.in.return')
-
-        invoice_line = cls.__table__()
         line_move = LineMove.__table__()
         move = Move.__table__()
-        shipment_out = ShipmentOut.__table__()
-        shipment_out_return = ShipmentOutReturn.__table__()
-        shipment_in = ShipmentIn.__table__()
-        shipment_in_return = ShipmentInReturn.__table__()
 
-        field, operator_, value = clause
+        companies = origin_companies()
+
+        negated = operator in POSITIVE_OPERATORS
+        if negated:
+            operator = POSITIVE_OPERATORS[operator]
+        Operator = fields.SQL_OPERATORS[operator]
+        value_date = cls._get_origin_shipment_date(value)
+        if value_date and Operator in (operators.Like, operators.ILike):
+            Operator = operators.Equal
 
-        Operator = fields.SQL_OPERATORS[operator_]
+        queries, shipped = [], []
+        for model in cls._origin_shipment_models:
+            shipment = pool.get(model).__table__()
+            if value_date:
+                where = Operator(shipment.effective_date, value_date)
+            else:
+                where = (Operator(shipment.number, value)
+                    | Operator(shipment.reference, value))
+            if companies:
+                where &= shipment.company.in_(companies)
+            shipments = shipment.select(
+                Concat(model + ',', Cast(shipment.id, 'VARCHAR')),
+                where=where)
+            queries.append(line_move.select(line_move.invoice_line,
+                    where=line_move.stock_move.in_(move.select(move.id,
+                            where=move.shipment.in_(shipments)))))
+            shipped.append(move.shipment.like(model + ',%'))
+
+        if negated:
+            # Anti-join on the lines matching the positive clause among the
+            # lines with a shipment
+            if not shipped:
+                return [('id', '=', None)]
+            where = reduce(or_, shipped)
+            if companies:
+                where &= move.company.in_(companies)
+            lines = line_move.join(move,
+                condition=line_move.stock_move == move.id
+                ).select(line_move.invoice_line, where=where)
+            return [
+                ('id', 'in', lines),
+                ('id', 'not in', Union(*queries)),
+                ]
+        if not queries:
+            return [('id', '=', None)]
+        return [('id', 'in', Union(*queries))]
 
+    @classmethod
+    def origin_shipment_models(cls):
+        return [
+            'stock.shipment.in',
+            'stock.shipment.in.return',
+            'stock.shipment.out',
+            'stock.shipment.out.return',
+            ]
+
+    @classmethod
+    def origin_shipment_fields(cls):
+        "Return the name and the string of the shipment field of each model"
+        return {
+            'stock.shipment.in': (
+                'origin_supplier_shipments', 'Supplier Shipments'),
+            'stock.shipment.in.return': (
+                'origin_supplier_shipment_returns',
+                'Supplier Shipment Returns'),
+            'stock.shipment.out': (
+                'origin_customer_shipments', 'Customer Shipments'),
+            'stock.shipment.out.return': (
+                'origin_customer_shipment_returns',
+                'Customer Shipment Returns'),
+            }
+
+    @staticmethod
+    def _get_origin_shipment_date(value):
+        "Return the value as ISO date if it matches the locale date format"
         try:
             locale = Transaction().context.get('locale')
             format_date = (locale.get('date', '%Y-%m-%d')
                 if locale else '%Y-%m-%d')
-            value_date = (datetime.strptime(value.replace('%', ''),
+            return (datetime.strptime(value.replace('%', ''),
                     format_date).strftime('%Y-%m-%d') if value else None)
-        except ValueError:
-            value_date = None
-
-        if value_date:
-            if Operator in (operators.Like, operators.ILike):
-                Operator = operators.Equal
-            elif Operator in (operators.NotLike, operators.NotILike):
-                Operator = operators.NotEqual
-
-            sql_where = (Operator(shipment_out.effective_date, value_date)
-                | Operator(shipment_out_return.effective_date, value_date)
-                | Operator(shipment_in.effective_date, value_date)
-                | Operator(shipment_in_return.effective_date, value_date))
-        else:
-            sql_where = (Operator(shipment_out.number, value)
-                | Operator(shipment_out_return.number, value)
-                | Operator(shipment_in.number, value)
-                | Operator(shipment_in_return.number, value)
-                | Operator(shipment_out.reference, value)
-                | Operator(shipment_out_return.reference, value)
-                | Operator(shipment_in.reference, value)
-                | Operator(shipment_in_return.reference, value))
-
-        query = invoice_line.join(line_move,
-            condition=invoice_line.id == line_move.invoice_line).join(
-            move, condition=move.id == line_move.stock_move)
-        query = query.join(shipment_out, 'LEFT',
-            condition=Cast(Substring(move.shipment, Position(
-            ',', move.shipment) + Literal(1)), 'INTEGER') == shipment_out.id)
-        query = query.join(shipment_out_return, 'LEFT',
-            condition=Cast(Substring(move.shipment, Position(
-            ',', move.shipment) + Literal(1)), 'INTEGER') == shipment_out_return.id)
-        query = query.join(shipment_in, 'LEFT',
-            condition=Cast(Substring(move.shipment, Position(
-            ',', move.shipment) + Literal(1)), 'INTEGER') == shipment_in.id)
-        query = query.join(shipment_in_return, 'LEFT',
-            condition=Cast(Substring(move.shipment, Position(
-            ',', move.shipment) + Literal(1)), 'INTEGER') == shipment_in_return.id)
-        query = query.select(invoice_line.id, where=sql_where)
+        except (ValueError, AttributeError):
+            return None
 
-        return [('id', 'in', query)]
+
+class InvoiceLineStockMove(metaclass=PoolMeta):
+    __name__ = 'account.invoice.line-stock.move'
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        super().on_modification(mode, records, field_names=field_names)
+        clear_origin_caches(counts_only=True)
+        if mode != 'delete' and origin_stored():
+            InvoiceLine.update_origin_cache(
+                InvoiceLine.browse({r.invoice_line.id for r in records}))
+
+    @classmethod
+    def on_delete(cls, records):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        callback = super().on_delete(records)
+        if origin_stored():
+            line_ids = list({r.invoice_line.id for r in records})
+            callback.append(lambda: InvoiceLine.update_origin_cache(
+                    InvoiceLine.browse(line_ids)))
+        return callback
@@ -0,0 +1,15 @@
+#This file is part account_invoice_line_origin module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('account.invoice.line|update_origin_cache',
+                "Update Invoice Line Origin Cache"))
@@ -0,0 +1,40 @@
+#This file is part account_invoice_line_origin module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from trytond.model import Index
+from trytond.pool import Pool, PoolMeta
+
+from .invoice import clear_origin_caches, origin_stored
+
+
+class Purchase(metaclass=PoolMeta):
+    __name__ = 'purchase.purchase'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.number, Index.Similarity())),
+                Index(t, (t.reference, Index.Similarity())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.number, Index.Equality())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.reference, Index.Equality())),
+                })
+
+    @classmethod
+    def on_modification(cls, mode, purchases, field_names=None):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        super().on_modification(mode, purchases, field_names=field_names)
+        if (mode == 'write'
+                and field_names & {'number', 'reference', 'purchase_date'}):
+            clear_origin_caches()
+        if (mode == 'write' and origin_stored()
+                and field_names & {'number', 'reference', 'purchase_date'}):
+            InvoiceLine.update_origin_cache(InvoiceLine.browse(
+                    InvoiceLine._get_origin_cache_lines(
+                        'purchase.line', [p.id for p in purchases])))
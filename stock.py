@@ -0,0 +1,124 @@
+#This file is part account_invoice_line_origin module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+from collections import defaultdict
+from trytond.model import fields, Index
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from sql import Null
+
+from .invoice import clear_origin_caches, origin_stored
+
+
+class Invoice(metaclass=PoolMeta):
+    __name__ = 'account.invoice'
+    origin_shipments = fields.Function(fields.Char('Origin Shipments'),
+        'get_origin_shipments', searcher='search_origin_shipments')
+
+    @classmethod
+    def get_origin_shipments(cls, invoices, name):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        LineMove = pool.get('account.invoice.line-stock.move')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        line = InvoiceLine.__table__()
+        line_move = LineMove.__table__()
+        move = Move.__table__()
+
+        invoice_shipments = defaultdict(set)
+        for sub_invoices in grouped_slice(invoices):
+            cursor.execute(*line.join(line_move,
+                    condition=line_move.invoice_line == line.id
+                    ).join(move,
+                    condition=line_move.stock_move == move.id
+                    ).select(line.invoice, move.shipment,
+                    where=reduce_ids(
+                        line.invoice, [i.id for i in sub_invoices])
+                    & (move.shipment != Null),
+                    group_by=[line.invoice, move.shipment]))
+            for invoice_id, shipment in cursor:
+                model, _, shipment_id = shipment.partition(',')
+                if model not in InvoiceLine._origin_shipment_models:
+                    continue
+                try:
+                    shipment_id = int(shipment_id)
+                except ValueError:
+                    continue
+                if shipment_id >= 0:
+                    invoice_shipments[invoice_id].add((model, shipment_id))
+
+        labels = InvoiceLine._get_origin_shipment_labels(invoice_shipments)
+        return {i.id: labels.get(i.id) for i in invoices}
+
+    @classmethod
+    def search_origin_shipments(cls, name, clause):
+        return [('lines.origin_shipment',) + tuple(clause[1:])]
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        super().on_modification(mode, moves, field_names=field_names)
+        if mode == 'write' and 'shipment' in field_names:
+            clear_origin_caches(counts_only=True)
+        if mode == 'write' and origin_stored() and 'shipment' in field_names:
+            InvoiceLine.update_origin_cache(InvoiceLine.browse(
+                    InvoiceLine._get_origin_shipment_cache_lines(
+                        moves=[m.id for m in moves])))
+
+
+class ShipmentOriginMixin:
+    __slots__ = ()
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.number, Index.Similarity())),
+                Index(t, (t.reference, Index.Similarity())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.number, Index.Equality())),
+                Index(t,
+                    (t.company, Index.Equality()),
+                    (t.reference, Index.Equality())),
+                Index(t, (t.effective_date, Index.Range()),
+                    where=t.effective_date != Null),
+                })
+
+    @classmethod
+    def on_modification(cls, mode, shipments, field_names=None):
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        super().on_modification(mode, shipments, field_names=field_names)
+        if (mode == 'write'
+                and field_names & {'number', 'reference', 'effective_date'}):
+            clear_origin_caches(counts_only=True)
+        if (mode == 'write' and origin_stored()
+                and field_names & {'number', 'reference', 'effective_date'}):
+            InvoiceLine.update_origin_cache(InvoiceLine.browse(
+                    InvoiceLine._get_origin_shipment_cache_lines(
+                        shipments=[str(s) for s in shipments])))
+
+
+class ShipmentIn(ShipmentOriginMixin, metaclass=PoolMeta):
+    __name__ = 'stock.shipment.in'
+
+
+class ShipmentInReturn(ShipmentOriginMixin, metaclass=PoolMeta):
+    __name__ = 'stock.shipment.in.return'
+
+
+class ShipmentOut(ShipmentOriginMixin, metaclass=PoolMeta):
+    __name__ = 'stock.shipment.out'
+
+
+class ShipmentOutReturn(ShipmentOriginMixin, metaclass=PoolMeta):
+    __name__ = 'stock.shipment.out.return'
@@ -0,0 +1,386 @@
+#This file is part account_invoice_line_origin module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+"""Benchmark of the origin getters and searchers of the invoice lines.
+
+It creates a database with the test configuration (DB_NAME and
+TRYTOND_DATABASE_URI environment variables), generates the requested volume
+of sales, purchases, invoices, stock moves and shipments by cloning template
+records with SQL and reports for each getter and searcher the wall time, the
+number of SQL queries and, on PostgreSQL, the number of rows read.
+
+    python -m trytond.modules.account_invoice_line_origin.tests.\\
+benchmark_origin --lines 10000 100000
+"""
+import argparse
+import datetime
+import logging
+import random
+import sys
+import time
+from decimal import Decimal
+
+from sql import Table
+from sql.aggregate import Max
+
+from proteus import Model
+from trytond import backend
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    set_fiscalyear_invoice_sequences)
+from trytond.modules.account_invoice_line_origin.invoice import (
+    origin_parent_cache)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+MODULES = ['account_invoice_line_origin', 'account_invoice_stock',
+    'purchase', 'sale']
+DATE_FORMAT = '%Y-%m-%d'
+CHUNK = 1000
+
+
+class QueryCounter(logging.Handler):
+    "Count the queries logged by the database backends"
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def create_templates():
+    "Create with the ORM one record of each kind and return their ids"
+    activate_modules(MODULES)
+
+    _ = create_company()
+    company = get_company()
+    fiscalyear = set_fiscalyear_invoice_sequences(
+        create_fiscalyear(company))
+    fiscalyear.click('create_period')
+    _ = create_chart(company)
+    accounts = get_accounts(company)
+
+    Party = Model.get('party.party')
+    supplier = Party(name='Supplier')
+    supplier.save()
+    customer = Party(name='Customer')
+    customer.save()
+
+    ProductCategory = Model.get('product.category')
+    account_category = ProductCategory(name="Account Category")
+    account_category.accounting = True
+    account_category.account_expense = accounts['expense']
+    account_category.account_revenue = accounts['revenue']
+    account_category.save()
+
+    ProductUom = Model.get('product.uom')
+    unit, = ProductUom.find([('name', '=', 'Unit')])
+    ProductTemplate = Model.get('product.template')
+    template = ProductTemplate()
+    template.name = 'product'
+    template.default_uom = unit
+    template.type = 'goods'
+    template.purchasable = True
+    template.salable = True
+    template.list_price = Decimal('10')
+    template.account_category = account_category
+    template.save()
+    product, = template.products
+
+    Purchase = Model.get('purchase.purchase')
+    purchase = Purchase()
+    purchase.party = supplier
+    purchase.invoice_method = 'order'
+    purchase_line = purchase.lines.new()
+    purchase_line.product = product
+    purchase_line.quantity = 1
+    purchase_line.unit_price = Decimal('10')
+    purchase.click('quote')
+    purchase.click('confirm')
+    purchase.click('process')
+    purchase.reload()
+
+    Move = Model.get('stock.move')
+    ShipmentIn = Model.get('stock.shipment.in')
+    shipment_in = ShipmentIn()
+    shipment_in.supplier = supplier
+    shipment_in.incoming_moves.append(Move(id=purchase.moves[0].id))
+    shipment_in.save()
+    shipment_in.click('receive')
+    shipment_in.click('do')
+
+    Sale = Model.get('sale.sale')
+    sale = Sale()
+    sale.party = customer
+    sale.invoice_method = 'order'
+    sale_line = sale.lines.new()
+    sale_line.product = product
+    sale_line.quantity = 1
+    sale.click('quote')
+    sale.click('confirm')
+    sale.click('process')
+    sale.reload()
+
+    sale_invoice, = sale.invoices
+    purchase_invoice, = purchase.invoices
+    return {
+        'company': company.id,
+        'sale_sale': sale.id,
+        'sale_line': sale.lines[0].id,
+        'purchase_purchase': purchase.id,
+        'purchase_line': purchase.lines[0].id,
+        'sale_invoice': sale_invoice.id,
+        'sale_invoice_line': sale_invoice.lines[0].id,
+        'purchase_invoice': purchase_invoice.id,
+        'purchase_invoice_line': purchase_invoice.lines[0].id,
+        'sale_move': sale.moves[0].id,
+        'purchase_move': purchase.moves[0].id,
+        'stock_shipment_out': sale.shipments[0].id,
+        'stock_shipment_in': shipment_in.id,
+        }
+
+
+def clone(table_name, template_id, overrides):
+    """Insert a copy of the template row for each dictionary of overrides and
+    return the list of new ids"""
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    table = Table(table_name)
+
+    cursor.execute(*table.select(where=table.id == template_id))
+    columns = [d[0] for d in cursor.description]
+    template = dict(zip(columns, cursor.fetchone()))
+    cursor.execute(*table.select(Max(table.id)))
+    next_id = (cursor.fetchone()[0] or 0) + 1
+
+    ids = list(range(next_id, next_id + len(overrides)))
+    for i in range(0, len(overrides), CHUNK):
+        values = []
+        for id_, override in zip(ids[i:i + CHUNK], overrides[i:i + CHUNK]):
+            row = dict(template, id=id_, **override)
+            values.append([row[c] for c in columns])
+        cursor.execute(*table.insert(
+                [getattr(table, c) for c in columns], values))
+    transaction.database.setnextid(
+        transaction.connection, table_name, next_id + len(overrides))
+    return ids
+
+
+def generate(templates, lines, seed=0):
+    """Generate about lines invoice lines with their origins.
+
+    45% of the lines come from sales, 45% from purchases and 10% are credit
+    lines whose origin is another invoice line. Each sale and purchase has 5
+    lines, each invoice 20 lines and each shipment 10 moves."""
+    rng = random.Random(seed)
+    start = datetime.date.today() - datetime.timedelta(days=730)
+
+    def date():
+        return start + datetime.timedelta(days=rng.randrange(730))
+
+    def reference(prefix, i):
+        return '%s%07d' % (prefix, i) if rng.random() < 0.5 else None
+
+    origin_lines = []
+    for kind, prefix, shipment_model in [
+            ('sale', 'S', 'stock.shipment.out'),
+            ('purchase', 'P', 'stock.shipment.in')]:
+        count = int(lines * 0.45)
+        parent_table = '%s_%s' % (kind, kind)
+        parents = clone(parent_table, templates[parent_table], [{
+                    'number': '%s%07d' % (prefix, i),
+                    'reference': reference(prefix + 'REF', i),
+                    kind + '_date': date(),
+                    } for i in range(count // 5 + 1)])
+        origins = clone('%s_line' % kind, templates['%s_line' % kind], [
+                {kind: parents[i // 5]} for i in range(count)])
+
+        shipment_table = shipment_model.replace('.', '_')
+        shipments = clone(shipment_table, templates[shipment_table], [{
+                    'number': '%sH%07d' % (prefix, i),
+                    'reference': reference(prefix + 'HREF', i),
+                    'effective_date': date(),
+                    } for i in range(count // 10 + 1)])
+        moves = clone('stock_move', templates[kind + '_move'], [{
+                    'origin': '%s.line,%s' % (kind, o),
+                    'shipment': '%s,%s' % (shipment_model, shipments[i // 10]),
+                    } for i, o in enumerate(origins)])
+
+        invoices = clone('account_invoice', templates[kind + '_invoice'], [{
+                    'number': '%sI%07d' % (prefix, i),
+                    'reference': reference(prefix + 'IREF', i),
+                    'invoice_date': date(),
+                    } for i in range(count // 20 + 1)])
+        invoice_lines = clone('account_invoice_line',
+            templates[kind + '_invoice_line'], [{
+                    'invoice': invoices[i // 20],
+                    'origin': '%s.line,%s' % (kind, o),
+                    } for i, o in enumerate(origins)])
+        clone_relation(invoice_lines, moves)
+        origin_lines.append((kind, invoices, invoice_lines))
+
+    count = lines - sum(len(l) for _, _, l in origin_lines)
+    for kind, invoices, invoice_lines in origin_lines:
+        credit_count = count // 2
+        clone('account_invoice_line', templates[kind + '_invoice_line'], [{
+                    'invoice': rng.choice(invoices),
+                    'origin': 'account.invoice.line,%s' % rng.choice(
+                        invoice_lines),
+                    } for i in range(credit_count)])
+
+
+def clone_relation(invoice_lines, moves):
+    LineMove = Pool().get('account.invoice.line-stock.move')
+    cursor = Transaction().connection.cursor()
+    table = LineMove.__table__()
+    for i in range(0, len(invoice_lines), CHUNK):
+        cursor.execute(*table.insert(
+                [table.invoice_line, table.stock_move],
+                [[l, m] for l, m in zip(
+                        invoice_lines[i:i + CHUNK], moves[i:i + CHUNK])]))
+
+
+def rows_read():
+    "Return the number of rows read by the transaction or None"
+    if backend.name != 'postgresql':
+        return None
+    cursor = Transaction().connection.cursor()
+    cursor.execute('SELECT COALESCE(SUM(seq_tup_read), 0) '
+        '+ COALESCE(SUM(idx_tup_fetch), 0) FROM pg_stat_xact_user_tables')
+    return int(cursor.fetchone()[0])
+
+
+def measure(counter, function, repeat):
+    "Return the best wall time, queries, rows read and result of function"
+    best = None
+    for _ in range(repeat):
+        rows = rows_read()
+        counter.count = 0
+        start = time.perf_counter()
+        result = function()
+        duration = time.perf_counter() - start
+        queries = counter.count
+        if rows is not None:
+            rows = rows_read() - rows
+        if best is None or duration < best[0]:
+            best = (duration, queries, rows, result)
+    return best
+
+
+def cases(today):
+    "Yield the name and the domain of each searcher case"
+    past = today - datetime.timedelta(days=365)
+    for name, value in [
+            ('origin_number', 'S0000001'),
+            ('origin_reference', 'PREF0000002'),
+            ]:
+        yield name, [(name, '=', value)]
+        yield name, [(name, '!=', value)]
+        yield name, [(name, 'ilike', '%' + value[-4:] + '%')]
+        yield name, [(name, 'not ilike', '%' + value[-4:] + '%')]
+        yield name, [(name, 'in', [value, value[:-1] + '3'])]
+    yield 'origin_date', [('origin_date', '=', past)]
+    yield 'origin_date', [('origin_date', '!=', past)]
+    yield 'origin_date', [
+        ('origin_date', '>=', past),
+        ('origin_date', '<', past + datetime.timedelta(days=30)),
+        ]
+    yield 'origin_shipment', [('origin_shipment', '=', 'SH0000001')]
+    yield 'origin_shipment', [('origin_shipment', '!=', 'SH0000001')]
+    yield 'origin_shipment', [('origin_shipment', 'ilike', '%0001%')]
+    yield 'origin_shipment', [('origin_shipment', 'not ilike', '%0001%')]
+    yield 'origin_shipment', [
+        ('origin_shipment', '=', past.strftime(DATE_FORMAT))]
+    yield 'origin_shipment_date', [
+        ('origin_shipment_date', '>=', past),
+        ('origin_shipment_date', '<', past + datetime.timedelta(days=30)),
+        ]
+
+
+def run(counter, volume, page, repeat, output):
+    pool = Pool()
+    InvoiceLine = pool.get('account.invoice.line')
+
+    def report(*values):
+        line = ' | '.join(str(v) for v in values)
+        print(line)
+        output.write(line + '\n')
+
+    transaction = Transaction()
+    report('lines', 'case', 'domain', 'result', 'seconds', 'queries',
+        'rows read')
+    line_ids = [l.id for l in InvoiceLine.search([], limit=page)]
+    for names in [
+            ['origin_number', 'origin_reference', 'origin_date'],
+            ['origin_shipment'],
+            ]:
+        def read():
+            transaction.cache.clear()
+            origin_parent_cache().clear()
+            return len(InvoiceLine.read(line_ids, names))
+        duration, queries, rows, result = measure(counter, read, repeat)
+        report(volume, 'read', ','.join(names), result,
+            '%.4f' % duration, queries, rows if rows is not None else '-')
+
+    def export():
+        origin_parent_cache().clear()
+        return sum(1 for _ in InvoiceLine.iter_origin_data([]))
+    duration, queries, rows, result = measure(counter, export, repeat)
+    report(volume, 'export', [], result,
+        '%.4f' % duration, queries, rows if rows is not None else '-')
+
+    for name, domain in cases(datetime.date.today()):
+        def search():
+            return len(InvoiceLine.search(domain))
+        duration, queries, rows, result = measure(counter, search, repeat)
+        report(volume, 'search', domain, result,
+            '%.4f' % duration, queries, rows if rows is not None else '-')
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, nargs='+', default=[10000],
+        help="number of invoice lines to generate (default: 10000)")
+    parser.add_argument('--page', type=int, default=1000,
+        help="number of lines read by the getters (default: 1000)")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="number of runs of each case, the best is kept (default: 3)")
+    parser.add_argument('--output', type=argparse.FileType('w'),
+        default='bench_output.txt',
+        help="file to write the results (default: bench_output.txt)")
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(arguments)
+
+    # The handler must be set before the connections are opened
+    counter = QueryCounter()
+    for name in ['trytond.backend.postgresql.database',
+            'trytond.backend.sqlite.database']:
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(counter)
+
+    for volume in options.lines:
+        drop_db()
+        templates = create_templates()
+        context = {
+            'company': templates['company'],
+            'locale': {'date': DATE_FORMAT},
+            }
+        with Transaction().start(DB_NAME, 0, context=context) as transaction:
+            generate(templates, volume, seed=options.seed)
+            transaction.commit()
+            run(counter, volume, options.page, options.repeat,
+                options.output)
+            transaction.rollback()
+    drop_db()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,12 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import re
+from unittest.mock import patch
+
 from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
 
 class AccountInvoiceLineOriginTestCase(CompanyTestMixin, ModuleTestCase):
@@ -11,5 +15,98 @@ class AccountInvoiceLineOriginTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'account_invoice_line_origin'
     extras = ['account_invoice_stock', 'purchase', 'sale']
 
+    @with_transaction()
+    def test_origin_models(self):
+        "Test the registry of the origin models"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        self.assertEqual(InvoiceLine._origin_models['sale.line'], {
+                'parent': 'sale',
+                'parent_model': 'sale.sale',
+                'number': 'number',
+                'reference': 'reference',
+                'date': 'sale_date',
+                'invoice_type': 'out',
+                })
+        self.assertEqual(
+            InvoiceLine._get_origin_parent_names(
+                'origin_reference', 'purchase.line'),
+            ['reference', 'number'])
+        self.assertEqual(
+            InvoiceLine._get_origin_parent_names(
+                'origin_date', 'account.invoice.line'),
+            ['invoice_date'])
+        self.assertEqual(
+            set(InvoiceLine._get_origin_search_plan(
+                    'origin_number', False, 'in')),
+            {'account.invoice.line', 'purchase.line'})
+
+    @with_transaction()
+    def test_origin_invoice_type_inference(self):
+        "Test the invoice type is inferred only with origin clauses"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+
+        with patch.object(InvoiceLine, '_get_origin_invoice_type',
+                return_value=None) as get_invoice_type:
+            InvoiceLine.search([('invoice', 'in', [1, 2])])
+            get_invoice_type.assert_not_called()
+            InvoiceLine.search([
+                    ('invoice', 'in', [1, 2]),
+                    ['OR', ('origin_number', '=', '1'), ('id', '=', 1)],
+                    ])
+            get_invoice_type.assert_called()
+
+        with patch.object(InvoiceLine, '_get_origin_invoice_type',
+                return_value='in'), \
+                patch.object(InvoiceLine, '_search_origin_merged',
+                    return_value=[('id', '=', None)]) as search_merged:
+            InvoiceLine.search([
+                    ('invoice.type', '=', 'in'),
+                    ['OR',
+                        ('origin_number', '=', '1'),
+                        ('origin_reference', '=', '2')],
+                    ])
+            self.assertEqual(
+                [c.args for c in search_merged.call_args_list], [
+                    ([('origin_number', '=', '1')], 'in'),
+                    ([('origin_reference', '=', '2')], 'in'),
+                    ])
+
+    @with_transaction()
+    def test_origin_model_id(self):
+        "Test the id of the origin keeps all the integer ids"
+        pool = Pool()
+        InvoiceLine = pool.get('account.invoice.line')
+        table = InvoiceLine.__table__()
+
+        with patch('trytond.modules.account_invoice_line_origin.invoice'
+                '.backend') as backend:
+            backend.name = 'postgresql'
+            _, origin_id = InvoiceLine._get_origin_model_id(table)
+        sql, params = tuple(table.select(origin_id))
+        self.assertIn('BIGINT', sql)
+        pattern, = [p for p in params if isinstance(p, str)
+            and p.startswith('^')]
+        self.assertTrue(re.match(pattern, '2147483647'))
+        self.assertFalse(re.match(pattern, ''))
+        self.assertFalse(re.match(pattern, '12345678901'))
+
+    @with_transaction()
+    def test_update_origin_cache_cron(self):
+        "Test the scheduled action filling the origin cache"
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        ModelData = pool.get('ir.model.data')
+        InvoiceLine = pool.get('account.invoice.line')
+
+        cron = Cron(ModelData.get_id(
+                'account_invoice_line_origin', 'cron_update_origin_cache'))
+        self.assertFalse(cron.active)
+        with patch.object(InvoiceLine, 'update_origin_cache') as update:
+            Cron.run_once([cron])
+            update.assert_called_once_with()
+
 
 del ModuleTestCase
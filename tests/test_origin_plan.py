@@ -0,0 +1,126 @@
+#This file is part account_invoice_line_origin module for Tryton.
+#The COPYRIGHT file at the top level of this repository contains
+#the full copyright notices and license terms.
+"""Query plan regression tests of the origin searchers.
+
+They generate a mid-sized database with the benchmark data and check on
+PostgreSQL the plan of the query built for each searcher case: the equality
+searches must not read sequentially the invoice lines and the estimated cost
+of every search must stay below a multiple of the cost of reading them all.
+"""
+import datetime
+import json
+import unittest
+
+from trytond import backend
+from trytond.modules.account_invoice_line_origin.tests.benchmark_origin \
+    import DATE_FORMAT, create_templates, generate
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
+from trytond.transaction import Transaction
+
+
+def plan_nodes(plan):
+    "Yield the node of the plan and all its sub-nodes"
+    yield plan
+    for sub_plan in plan.get('Plans', []):
+        yield from plan_nodes(sub_plan)
+
+
+def cases(today):
+    """Yield the domain of each searcher case and if the invoice lines must be
+    read through an index"""
+    past = today - datetime.timedelta(days=365)
+    for name, value in [
+            ('origin_number', 'S0000001'),
+            ('origin_reference', 'PREF0000002'),
+            ('root_origin_number', 'P0000003'),
+            ]:
+        indexed = not name.startswith('root_')
+        yield [(name, '=', value)], indexed
+        yield [(name, 'in', [value, value[:-1] + '4'])], indexed
+        yield [(name, '!=', value)], False
+        yield [(name, 'ilike', '%' + value[-4:] + '%')], False
+        yield [(name, 'not ilike', '%' + value[-4:] + '%')], False
+    yield [('origin_date', '=', past)], True
+    yield [('origin_date', '!=', past)], False
+    yield [
+        ('origin_date', '>=', past),
+        ('origin_date', '<', past + datetime.timedelta(days=30)),
+        ], False
+    yield [('origin_shipment', '=', 'SH0000001')], True
+    yield [('origin_shipment', '=', past.strftime(DATE_FORMAT))], True
+    yield [('origin_shipment', '!=', 'SH0000001')], False
+    yield [('origin_shipment', 'ilike', '%0001%')], False
+    yield [('origin_shipment', 'not ilike', '%0001%')], False
+    yield [('origin_customer_shipments.number', '=', 'SH0000001')], True
+    yield [('origin_shipment_date', '=', past)], True
+    yield [
+        ('origin_shipment_date', '>=', past),
+        ('origin_shipment_date', '<', past + datetime.timedelta(days=30)),
+        ], False
+
+
+@unittest.skipIf(backend.name != 'postgresql', "requires PostgreSQL")
+class OriginPlanTestCase(unittest.TestCase):
+    "Test the query plans of the origin searchers"
+    lines = 50000
+    # Maximum estimated cost relative to a sequential read of the lines
+    indexed_cost = 1
+    cost = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        drop_db()
+        cls.templates = create_templates()
+        with Transaction().start(DB_NAME, 0, context=cls.context()) as (
+                transaction):
+            generate(cls.templates, cls.lines)
+            transaction.connection.cursor().execute('ANALYZE')
+            transaction.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        drop_db()
+        super().tearDownClass()
+
+    @classmethod
+    def context(cls):
+        return {
+            'company': cls.templates['company'],
+            'locale': {'date': DATE_FORMAT},
+            }
+
+    def explain(self, sql, params=()):
+        "Return the JSON plan of the query"
+        cursor = Transaction().connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan, = cursor.fetchone()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def test_search_plans(self):
+        "Test the plans of the origin searches"
+        with Transaction().start(DB_NAME, 0, context=self.context()):
+            pool = Pool()
+            InvoiceLine = pool.get('account.invoice.line')
+            table = InvoiceLine._table
+
+            full_cost = self.explain(
+                'SELECT id FROM "%s"' % table)['Total Cost']
+            for domain, indexed in cases(datetime.date.today()):
+                with self.subTest(domain=domain):
+                    query = InvoiceLine.search(domain, order=[], query=True)
+                    plan = self.explain(*tuple(query))
+                    if indexed:
+                        self.assertNotIn(('Seq Scan', table), [
+                                (n['Node Type'], n.get('Relation Name'))
+                                for n in plan_nodes(plan)])
+                        self.assertLessEqual(
+                            plan['Total Cost'],
+                            full_cost * self.indexed_cost)
+                    else:
+                        self.assertLessEqual(
+                            plan['Total Cost'], full_cost * self.cost)
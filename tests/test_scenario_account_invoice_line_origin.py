@@ -1,16 +1,21 @@
 import datetime
 import unittest
 from decimal import Decimal
+from unittest.mock import patch
 
 from proteus import Model
+from proteus.config import get_config
+from trytond import config
 from trytond.modules.account.tests.tools import (create_chart,
                                                  create_fiscalyear,
                                                  get_accounts)
 from trytond.modules.account_invoice.tests.tools import (
     create_payment_term, set_fiscalyear_invoice_sequences)
 from trytond.modules.company.tests.tools import create_company, get_company
-from trytond.tests.test_tryton import drop_db
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, drop_db
 from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
 
 
 class Test(unittest.TestCase):
@@ -210,20 +215,362 @@ class Test(unittest.TestCase):
         self.assertEqual(len(Line.find()), 18)
         self.assertEqual(len(Line.find([('origin_number', '=', '2')])), 6)
         self.assertEqual(len(Line.find([('origin_number', '=', 'ABC')])), 0)
+        self.assertEqual(len(Line.find([
+                        ('invoice.type', '=', 'in'),
+                        ('origin_number', '=', '2'),
+                        ])), 3)
+        self.assertEqual(len(Line.find([
+                        ('invoice_type', '=', 'out'),
+                        ('origin_number', '!=', '2'),
+                        ])), 6)
+        invoice, = purchase.invoices
+        self.assertEqual(len(Line.find([
+                        ('invoice', '=', invoice.id),
+                        ('origin_number', '=', '1'),
+                        ])), 3)
+        self.assertEqual(len(Line.find([('origin_number', '!=', '2')])), 12)
+        self.assertEqual(
+            len(Line.find([('origin_reference', 'ilike', '%AB%')])), 3)
         self.assertEqual(len(Line.find([('origin_reference', '=', '2')])), 6)
         self.assertEqual(len(Line.find([('origin_reference', '=', 'ABC')])), 3)
+        self.assertEqual(
+            len(Line.find([('origin_reference', '!=', 'ABC')])), 15)
+        self.assertEqual(
+            len(Line.find([('origin_reference', 'not ilike', '%AB%')])), 15)
+        self.assertEqual(
+            len(Line.find([('origin_number', 'not in', ['1', '3'])])), 6)
         self.assertEqual(
             len(
                 set([
                     l.origin.__class__
                     for l in Line.find([('origin_reference', '=', '2')])
                 ])), 2)
+        origin_lines = Line.get_origin_lines(
+            'origin_reference', ['2', 'ABC', 'XYZ'], get_config().context)
+        self.assertEqual(
+            {v: len(l) for v, l in origin_lines.items()},
+            {'2': 6, 'ABC': 3, 'XYZ': 0})
+        origin_lines = Line.get_origin_lines(
+            'origin_date', [yesterday], get_config().context)
+        self.assertEqual(
+            {v: len(l) for v, l in origin_lines.items()},
+            {yesterday.isoformat(): 6})
+        with self.assertRaises(ValueError):
+            Line.get_origin_lines('origin_shipment_cache', ['2'],
+                get_config().context)
+        context = get_config().context
+        with Transaction().start(
+                DB_NAME, get_config().user, context=context):
+            InvoiceLine = Pool().get('account.invoice.line')
+            data = list(InvoiceLine.iter_origin_data(
+                    [('origin_reference', '=', '2')], chunk_size=4))
+        self.assertEqual(
+            [d['id'] for d in data],
+            sorted(l.id for l in Line.find([('origin_reference', '=', '2')])))
+        self.assertEqual({d['origin_number'] for d in data}, {'2'})
+        self.assertEqual(
+            set(data[0]),
+            {'id', 'origin_number', 'origin_reference', 'origin_date',
+                'origin_shipment'})
+        self.assertEqual(Line.search_count(
+                [('origin_reference', '=', '2')], 0, None, context), 6)
+        self.assertEqual(Line.search_count(
+                [('origin_reference', '=', '2')], 0, 4, context), 4)
+        with Transaction().start(
+                DB_NAME, get_config().user,
+                context=dict(context, _check_access=True)):
+            InvoiceLine = Pool().get('account.invoice.line')
+            with patch.object(
+                    InvoiceLine, 'search', side_effect=AssertionError):
+                self.assertEqual(InvoiceLine.search_count(
+                        [('origin_reference', '=', '2')]), 6)
+                with Transaction().set_context(invoice_type='in'), \
+                        self.assertRaises(AssertionError):
+                    InvoiceLine.search_count(
+                        [('origin_reference', '=', '2')])
+        page_ids, after = [], None
+        while True:
+            ids, after = Line.search_origin_page([], after, 4, context)
+            if not ids:
+                break
+            page_ids.extend(ids)
+        lines = Line.find([])
+        self.assertEqual(page_ids, [l.id for l in sorted(lines,
+                    key=lambda l: (l.origin_date is None, l.origin_date, l.id))])
+        ids, after = Line.search_origin_page(
+            [('origin_reference', '=', '2')], None, 4, context)
+        self.assertEqual(len(ids), 4)
+        ids, after = Line.search_origin_page(
+            [('origin_reference', '=', '2')], after, 4, context)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(
+            len(Line.find([('origin_number', 'in', ['1', '3'])])), 12)
+        line, = Line.find([('origin_reference', '=', 'ABC')], limit=1)
+        self.assertEqual(line.origin_number, '2')
+        self.assertEqual(line.origin_reference, '2 / ABC')
+        self.assertEqual(line.origin_date, tomorrow)
         self.assertEqual(len(Line.find([('origin_date', '=', yesterday)])), 6)
-        self.assertEqual(len(Line.find([('origin_date', '>=', today)])), 12)
+        with self.assertNoLogs(
+                'trytond.modules.account_invoice_line_origin.invoice'), \
+                get_config().set_context(
+                    origin_profile=True, origin_explain=True):
+            self.assertEqual(
+                len(Line.find([('origin_number', '=', '2')])), 6)
+        if not config.has_section('account_invoice_line_origin'):
+            config.add_section('account_invoice_line_origin')
+        config.set('account_invoice_line_origin', 'profile', 'True')
+        config.set('account_invoice_line_origin', 'explain', 'True')
+        try:
+            with self.assertLogs(
+                    'trytond.modules.account_invoice_line_origin.invoice'):
+                self.assertEqual(
+                    len(Line.find([('origin_number', '=', '2')])), 6)
+            with self.assertNoLogs(
+                    'trytond.modules.account_invoice_line_origin.invoice'), \
+                    get_config().set_context(origin_profile=False):
+                self.assertEqual(
+                    len(Line.find([('origin_number', '=', '2')])), 6)
+            self.assertEqual(
+                len(Line.find([('origin_date', '>=', today)])), 12)
+            with self.assertLogs(
+                    'trytond.modules.account_invoice_line_origin.invoice'
+                    ) as logs:
+                self.assertEqual(len(Line.find([
+                                ('origin_number', '!=', '2'),
+                                ('origin_date', '>=', today),
+                                ])), 6)
+        finally:
+            config.set('account_invoice_line_origin', 'profile', 'False')
+            config.set('account_invoice_line_origin', 'explain', 'False')
+        if config.getboolean(
+                'account_invoice_line_origin', 'stored', default=False):
+            searcher = 'search_origin_reference'
+        else:
+            searcher = '_search_origin_merged'
+        self.assertTrue(any(
+                '.%s ' % searcher in o and 'lines in' in o
+                for o in logs.output))
+        self.assertEqual(len(Line.find(['OR', [
+                            ('origin_number', '=', '2'),
+                            ('origin_date', '=', tomorrow),
+                            ], [
+                            ('origin_reference', '=', '1'),
+                            ('origin_date', '=', today),
+                            ]])), 12)
+        lines = Line.find([], order=[('origin_date', 'DESC'), ('id', 'ASC')])
+        self.assertEqual(
+            [l.origin_date for l in lines],
+            [tomorrow] * 6 + [today] * 6 + [yesterday] * 6)
+        lines = Line.find([], order=[('origin_number', 'ASC')])
+        self.assertEqual(
+            [l.origin_number for l in lines],
+            ['1'] * 6 + ['2'] * 6 + ['3'] * 6)
+        lines = Line.find(
+            [('origin_number', '=', '2')],
+            order=[('origin_reference', 'DESC NULLS LAST')], limit=3)
+        self.assertEqual({l.origin_reference for l in lines}, {'2 / ABC'})
         self.assertEqual(len(Line.find([('origin_shipment', '!=', '1')])), 7)
         self.assertEqual(len(Line.find([('origin_shipment', '=', '2')])), 4)
         self.assertEqual(len(Line.find([('origin_shipment', '!=', '2')])), 8)
+        line, = Line.find([
+                ('origin_shipment', '=', '2'),
+                ('invoice.type', '=', 'in'),
+                ])
+        self.assertEqual(
+            line.origin_shipment, '2 - %s' % today.strftime('%m/%d/%Y'))
+        self.assertEqual(line.origin_supplier_shipments, [shipment2])
+        self.assertEqual(line.origin_customer_shipments, [])
+        self.assertEqual(
+            len(Line.find([('origin_supplier_shipments', '=', shipment2.id)])),
+            1)
+        self.assertEqual(
+            len(Line.find([('origin_supplier_shipments', '=', '2')])), 1)
+        self.assertEqual(
+            len(Line.find([
+                        ('origin_supplier_shipments.number', 'in', ['1', '2']),
+                        ])), 3)
+        self.assertEqual(
+            len(Line.find([('origin_customer_shipments', '!=', None)])), 9)
+        self.assertEqual(line.origin_shipment_date, today)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', '=', today)])), 3)
+        self.assertEqual(
+            len(Line.find([
+                        ('origin_shipment_date', '>=', yesterday),
+                        ('origin_shipment_date', '<=', today),
+                        ])), 3)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', '<', today)])), 0)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', '=', None)])), 15)
+        # A line with shipments on different dates has the last date
+        last_month = today - datetime.timedelta(days=30)
+        shipment3 = ShipmentIn()
+        shipment3.supplier = supplier
+        shipment3.effective_date = last_month
+        shipment3.incoming_moves.append(Move(id=purchase3.moves[0].id))
+        shipment3.save()
+        shipment3.click('receive')
+        shipment3.click('do')
+        line3, = Line.find([('origin', '=', str(purchase3.lines[0]))])
+        self.assertEqual(line3.origin_shipment_date, last_month)
+        line3.stock_moves.append(Move(purchase.moves[0].id))
+        line3.save()
+        self.assertEqual(line3.origin_shipment_date, today)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', '<', today)])), 0)
+        self.assertEqual(
+            len(Line.find([
+                        ('origin_shipment_date', '>=', last_month),
+                        ('origin_shipment_date', '<=', last_month),
+                        ])), 0)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', '=', today)])), 4)
+        self.assertEqual(
+            len(Line.find([('origin_shipment_date', 'in', [today])])), 4)
         self.assertEqual(
             len(
                 Line.find([('origin_shipment', '=', today.strftime('%m/%d/%Y'))
-                           ])), 9)
+                           ])), 4)
+
+        # Invoice origins
+        Invoice = Model.get('account.invoice')
+        invoice, = purchase2.invoices
+        self.assertEqual(invoice.origin_numbers, '2')
+        self.assertEqual(invoice.origin_start_date, tomorrow)
+        self.assertEqual(invoice.origin_end_date, tomorrow)
+        self.assertEqual(
+            invoice.origin_shipments, '2 - %s' % today.strftime('%m/%d/%Y'))
+        self.assertEqual(
+            len(Invoice.find([('origin_numbers', '=', '2')])), 2)
+        self.assertEqual(
+            len(Invoice.find([('origin_start_date', '>=', today)])), 4)
+        self.assertEqual(
+            len(Invoice.find([('origin_end_date', '<', today)])), 2)
+        self.assertEqual(
+            len(Invoice.find([('origin_shipments', '=', '2')])), 2)
+
+        # Credit a sale invoice line
+        sale_invoice, = sale2.invoices
+        credit = Invoice(type='out')
+        credit.party = customer
+        credit.payment_term = payment_term
+        credit_line = credit.lines.new()
+        credit_line.origin = sale_invoice.lines[0]
+        credit_line.product = product
+        credit_line.quantity = -1
+        credit_line.unit_price = Decimal('10')
+        credit.save()
+        credit_line, = credit.lines
+        self.assertEqual(credit_line.origin_number, None)
+        self.assertEqual(credit_line.root_origin_number, '2')
+        self.assertEqual(credit_line.root_origin_reference, '2 / ABC')
+        self.assertEqual(credit_line.root_origin_date, tomorrow)
+        self.assertEqual(
+            len(Line.find([('origin_reference', '=', 'ABC')])), 3)
+        self.assertEqual(
+            len(Line.find([('root_origin_reference', '=', 'ABC')])), 4)
+        self.assertEqual(
+            len(Line.find([('root_origin_number', '!=', '2')])), 12)
+        with Transaction().start(
+                DB_NAME, get_config().user,
+                context=get_config().context) as transaction:
+            InvoiceLine = Pool().get('account.invoice.line')
+            with patch.dict(
+                    InvoiceLine._origin_models['account.invoice.line'],
+                    reference=None):
+                line = InvoiceLine(credit_line.id)
+                InvoiceLine.update_origin_cache([line])
+                rec_name = line.origin.invoice.rec_name
+                self.assertEqual(line.origin_reference, rec_name)
+                self.assertEqual(InvoiceLine.search(
+                        [('origin_reference', '=', rec_name)]), [])
+            transaction.rollback()
+
+        # Second company
+        Company = Model.get('company.company')
+        User = Model.get('res.user')
+        party = Party(name='Second Company')
+        party.save()
+        company2 = Company(party=party, currency=company.currency)
+        company2.save()
+        user = User(get_config().user)
+        user.companies.append(Company(company2.id))
+        user.company = company2
+        user.save()
+        get_config()._context = User.get_preferences(True, {})
+        fiscalyear2 = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company2))
+        fiscalyear2.click('create_period')
+        _ = create_chart(company2)
+        accounts2 = get_accounts(company2)
+        account_category = ProductCategory(account_category.id)
+        account_category.account_expense = accounts2['expense']
+        account_category.account_revenue = accounts2['revenue']
+        account_category.save()
+        template = ProductTemplate(template.id)
+        template.list_price = Decimal('10')
+        template.save()
+
+        sale4 = Sale()
+        sale4.party = customer
+        sale4.payment_term = payment_term
+        sale4.invoice_method = 'order'
+        sale_line = sale4.lines.new()
+        sale_line.product = product
+        sale_line.quantity = 1.0
+        sale4.click('quote')
+        sale4.click('confirm')
+        sale4.click('process')
+        self.assertEqual(sale4.state, 'processing')
+        self.assertNotEqual(sale4.number, '2')
+        origin_lines = Line.get_origin_lines(
+            'origin_number', ['2', sale4.number], get_config().context)
+        self.assertEqual(
+            {v: len(l) for v, l in origin_lines.items()},
+            {'2': 0, sale4.number: 1})
+        self.assertEqual(len(Line.find([('origin_number', '=', '2')])), 0)
+        self.assertEqual(
+            len(Line.find([('origin_number', '=', sale4.number)])), 1)
+        self.assertEqual(len(Line.find([('origin_number', '!=', '2')])), 1)
+        with Transaction().start(
+                DB_NAME, get_config().user,
+                context=dict(get_config().context, _check_access=True)):
+            pool = Pool()
+            InvoiceLine = pool.get('account.invoice.line')
+            Rule = pool.get('ir.rule')
+            # Without the record rules only the origin searchers filter on
+            # the company
+            with patch.object(Rule, 'domain_get', return_value=[]):
+                self.assertEqual(len(InvoiceLine.search(
+                            [('origin_number', '=', '2')])), 0)
+                self.assertEqual({l.company.id for l in InvoiceLine.search(
+                            [('origin_shipment', 'ilike', '%')])},
+                    {company2.id})
+                self.assertEqual(len(InvoiceLine.search(
+                            [('origin_number', '=', sale4.number)])), 1)
+                Invoice = pool.get('account.invoice')
+                self.assertEqual({i.company.id for i in Invoice.search(
+                            [('origin_start_date', '<=', tomorrow)])},
+                    {company2.id})
+        user = User(get_config().user)
+        user.company_filter = 'all'
+        user.save()
+        get_config()._context = User.get_preferences(True, {})
+        self.assertEqual(len(Line.find([('origin_number', '=', '2')])), 6)
+        self.assertEqual(
+            len(Line.find([('origin_number', '=', sale4.number)])), 1)
+        self.assertEqual(len(Line.find([('origin_number', '!=', '2')])), 14)
+
+
+class TestStored(Test):
+
+    def setUp(self):
+        if not config.has_section('account_invoice_line_origin'):
+            config.add_section('account_invoice_line_origin')
+        config.set('account_invoice_line_origin', 'stored', 'True')
+        super().setUp()
+
+    def tearDown(self):
+        config.remove_section('account_invoice_line_origin')
+        super().tearDown()